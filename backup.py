@@ -0,0 +1,146 @@
+# online backup
+# consistent copies of favourites.db, pages.db and file_index.db while the crawler keeps writing
+
+# 1. open a read transaction on every database first, so all copies share one point in time
+# 2. copy each with the sqlite backup api a few pages per step, sleeping to cap the io rate
+# 3. write to .part files and rename when complete, optionally quick_check the copies
+
+# partitioned pages are copied file by file into a subdirectory, --active-only leaves out
+# sealed partitions, which only need copying once
+
+# with WAL the held read transactions don't block writers, they only stop
+# checkpoints from moving past the snapshot, so the -wal files grow until we finish
+# a database in rollback journal mode would be locked against writers for the whole copy,
+# so it gets no held transaction, the backup api copies it at its own point in time and
+# starts over if it's written to meanwhile
+
+import argparse
+
+from fugsy_lib import *
+from faves_get import DB_FAVES, DB_PAGES, DB_MEDIA
+from pages_store import is_partitioned, page_db_paths, CATALOG
+
+BACKUP_DIR = Path('backup')
+STEP_PAGES = 1024
+
+
+def open_snapshot(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    if mode.lower() != 'wal':
+        # every db the pipeline creates is switched to WAL by its init, this is one that hasn't been opened since
+        logging.warning(f'{Path(db_path).name} is in {mode} journal mode, copying it without the shared snapshot')
+        return conn
+    
+    conn.execute('BEGIN')
+    conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()  # the snapshot starts on first read
+    return conn
+
+
+def backup_database(src, dest_path, step_pages=STEP_PAGES, max_mbps=None, report_every=5.0):
+    page_size = src.execute('PRAGMA page_size').fetchone()[0]
+    part_path = dest_path.with_suffix(dest_path.suffix + '.part')
+    if part_path.exists():
+        part_path.unlink()
+    
+    start = time.time()
+    state = {'last_report': start, 'copied': 0}
+    
+    def progress(status, remaining, total):
+        state['copied'] = total - remaining
+        now = time.time()
+        
+        if max_mbps:
+            # sleep until the average rate is back under the cap
+            target = state['copied'] * page_size / (max_mbps * 2**20)
+            if target > now - start:
+                time.sleep(target - (now - start))
+        
+        if now - state['last_report'] >= report_every:
+            state['last_report'] = now
+            logging.info(
+                f'{dest_path.name}: {state["copied"]:,}/{total:,} pages '
+                f'({state["copied"] / max(total, 1):.0%}), {state["copied"] * page_size / 2**20 / (now - start):,.1f} MiB/s'
+            )
+    
+    dest = sqlite3.connect(part_path)
+    try:
+        src.backup(dest, pages=step_pages, progress=progress)
+    finally:
+        dest.close()
+    
+    os.replace(part_path, dest_path)
+    elapsed = time.time() - start
+    size = dest_path.stat().st_size
+    logging.info(f'{dest_path.name}: {size / 2**20:,.1f} MiB in {elapsed:,.1f}s ({size / 2**20 / max(elapsed, 1e-9):,.1f} MiB/s)')
+
+
+def verify_backup(path):
+    with sqlite3.connect(path) as conn:
+        result = conn.execute('PRAGMA quick_check').fetchone()[0]
+    
+    if result != 'ok':
+        logging.error(f'{path.name}: quick_check failed: {result}')
+        return False
+    
+    logging.info(f'{path.name}: quick_check ok')
+    return True
+
+
+def expand_paths(db_paths, sealed=True):
+    # (source, path relative to the backup dir), a partition directory becomes its files
+    expanded = []
+    for path in map(Path, db_paths):
+        if is_partitioned(path):
+            expanded.append((path / CATALOG, Path(path.name) / CATALOG))
+            expanded += [(Path(p), Path(path.name) / Path(p).name) for p in page_db_paths(path, sealed)]
+        else:
+            expanded.append((path, Path(path.name)))
+    
+    return expanded
+
+
+def backup_all(db_paths, out_dir=None, step_pages=STEP_PAGES, max_mbps=None, verify=False, sealed=True):
+    out_dir = out_dir or BACKUP_DIR / datetime.now().strftime('%Y%m%dT%H%M%S')
+    out_dir.mkdir(parents=True, exist_ok=True)
+    
+    # take every snapshot before copying anything
+    snapshots = [(path, rel, open_snapshot(path)) for path, rel in expand_paths(db_paths, sealed)]
+    logging.info(f'Snapshot of {len(snapshots)} databases taken at {datetime.now().isoformat()}')
+    
+    ok = True
+    try:
+        for path, rel, conn in snapshots:
+            dest = out_dir / rel
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            backup_database(conn, dest, step_pages, max_mbps)
+            if conn.in_transaction:
+                conn.execute('COMMIT')
+            
+            if verify:
+                ok = verify_backup(dest) and ok
+    finally:
+        for _, _, conn in snapshots:
+            conn.close()
+    
+    logging.info(f'Backup written to {out_dir}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Online backup of the fugsy databases.')
+    parser.add_argument('dbs', nargs='*', default=[DB_FAVES, DB_PAGES, DB_MEDIA])
+    parser.add_argument('--out', type=Path, help='Output directory, defaults to backup/<timestamp>')
+    parser.add_argument('--step-pages', type=int, default=STEP_PAGES, help='Pages copied per backup step')
+    parser.add_argument('--max-mbps', type=float, help='Cap the copy rate in MiB/s')
+    parser.add_argument('--verify', action='store_true', help='Run quick_check on each copy')
+    parser.add_argument('--active-only', action='store_true', help='Skip sealed pages partitions')
+    args = parser.parse_args()
+    
+    if not backup_all(args.dbs, args.out, args.step_pages, args.max_mbps, args.verify, sealed=not args.active_only):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    config_logger('backup')
+    main()
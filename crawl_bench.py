@@ -0,0 +1,280 @@
+# crawl benchmark
+# a local stand-in for FA serving a generated corpus, and a full faves_get run against it
+
+# serve: favourites pages, /view/<sid> pages, media and thumbnails, plus /add_posts to
+#  receive tell_added, with optional 5xx bursts and slow responses
+# run: start the stand-in, point faves_get at it and at throwaway databases, seed the
+#  import folder, run faves_get.main and report wall time and requests per second
+
+import argparse
+import io
+import random
+import tempfile
+import threading
+
+from flask import Flask, request, jsonify, abort
+
+import faves_get
+import fugsy_lib
+from fugsy_lib import *
+
+USER = 'codedcells'  # faves_get.main crawls this user
+PER_PAGE = 48
+
+app = Flask(__name__)
+
+corpus = {'faves': [], 'imports': [], 'per_page': PER_PAGE, 'seed': 0}
+faults = {'error_rate': 0.0, 'burst': 3, 'slow_rate': 0.0, 'slow_delay': 1.0}
+
+stats_lock = threading.Lock()
+stats = {'requests': {}, 'errors': 0, 'slow': 0, 'notified': 0, 'burst_left': 0}
+
+
+def build_corpus(posts, imports, per_page=PER_PAGE, seed=0):
+    # faves newest first like the real listing, imported posts aren't in the faves
+    rng = random.Random(seed)
+    sids = rng.sample(range(10_000_000, 60_000_000), posts + imports)
+    corpus['faves'] = sorted(sids[:posts], reverse=True)
+    corpus['imports'] = sids[posts:]
+    corpus['per_page'] = per_page
+    corpus['seed'] = seed
+
+
+def count(kind):
+    with stats_lock:
+        stats['requests'][kind] = stats['requests'].get(kind, 0) + 1
+
+
+def inject_faults():
+    # a 5xx starts a burst, so the client sees several in a row like during an outage
+    with stats_lock:
+        if stats['burst_left'] == 0 and random.random() < faults['error_rate']:
+            stats['burst_left'] = faults['burst']
+        
+        failing = stats['burst_left'] > 0
+        if failing:
+            stats['burst_left'] -= 1
+            stats['errors'] += 1
+        
+        slow = not failing and random.random() < faults['slow_rate']
+        if slow:
+            stats['slow'] += 1
+    
+    if slow:
+        time.sleep(faults['slow_delay'])
+    
+    if failing:
+        abort(503)
+
+
+def figure_html(sid):
+    return f'''
+        <figure id="sid-{sid}" class="r-general t-image">
+          <b><u><a href="/view/{sid}/"><img src="http://{request.host}/thumb/{sid}.png" data-tags="tag{sid % 7} tag{sid % 11}"></a></u></b>
+          <figcaption>
+            <p><a href="/view/{sid}/" title="Post {sid}">Post {sid}</a></p>
+            <p><i>by</i> <a href="/user/artist{sid % 50}/" title="artist{sid % 50}">Artist {sid % 50}</a></p>
+          </figcaption>
+        </figure>'''
+
+
+def view_html(sid):
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+  <meta property="og:url" content="https://www.furaffinity.net/view/{sid}/">
+  <title>Post {sid} by artist{sid % 50}</title>
+  <script>var key = "{random.getrandbits(64):x}";</script>
+</head>
+<body>
+  <div class="submission-id-sub-container">
+    <div class="submission-title"><h2><p>Post {sid}</p></h2></div>
+    by <a href="/user/artist{sid % 50}/">Artist {sid % 50}</a>
+    <span class="popup_date" title="Mar 5th, 2021 10:00 PM">4 years ago</span>
+  </div>
+  <div class="rating"><span class="rating-box">General</span></div>
+  <section class="tags-row"><span class="tags"><a href="/search/@keywords tag{sid % 7}">tag{sid % 7}</a></span><span class="tags"><a href="/search/@keywords tag{sid % 11}">tag{sid % 11}</a></span></section>
+  <div class="aligncenter auto_link hideonfull1 favorite-nav">
+    <a href="/fav/{sid}/">+Fav</a>
+    <a href="http://{request.host}/art/artist{sid % 50}/{sid}/{sid}.artist{sid % 50}_post.png">Download</a>
+  </div>
+  <div class="submission-description">{' '.join(f'Description line {i} for {sid}.' for i in range(40))}</div>
+</body>
+</html>'''
+
+
+def render_image(sid, size):
+    rng = random.Random(sid)
+    image = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    pixels = image.load()
+    for _ in range(12):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        for x in range(x0, min(size, x0 + size // 4)):
+            for y in range(y0, min(size, y0 + size // 4)):
+                pixels[x, y] = colour
+    
+    buf = io.BytesIO()
+    image.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+@app.route('/favorites/<user>/')
+@app.route('/favorites/<user>/<int:page>/next')
+def favourites(user, page=1):
+    count('favourites')
+    inject_faults()
+    
+    per_page = corpus['per_page']
+    sids = corpus['faves'][(page - 1) * per_page:page * per_page] if user == USER else []
+    next_form = ''
+    if page * per_page < len(corpus['faves']) and user == USER:
+        next_form = f'<form action="/favorites/{user}/{page + 1}/next" method="get"><button class="button standard" type="submit">Next</button></form>'
+    
+    return f'<html><body><section class="gallery">{"".join(figure_html(sid) for sid in sids)}</section>{next_form}</body></html>'
+
+
+@app.route('/view/<int:sid>/', strict_slashes=False)
+def view(sid):
+    count('view')
+    inject_faults()
+    return view_html(sid)
+
+
+@app.route('/art/<artist>/<int:sid>/<name>')
+def media(artist, sid, name):
+    count('media')
+    inject_faults()
+    return render_image(sid, 256), 200, {'Content-Type': 'image/png'}
+
+
+@app.route('/thumb/<int:sid>.png')
+def thumbnail(sid):
+    count('thumbnail')
+    inject_faults()
+    return render_image(sid, 64), 200, {'Content-Type': 'image/png'}
+
+
+@app.route('/add_posts', methods=['POST'])
+def add_posts():
+    count('add_posts')
+    with stats_lock:
+        stats['notified'] += len(request.get_json().get('post_ids', []))
+    
+    return jsonify({'ok': True})
+
+
+def start_server(host, port):
+    from werkzeug.serving import make_server
+    
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure(args):
+    build_corpus(args.posts, args.imports, args.per_page, args.seed)
+    random.seed(args.seed)
+    faults.update(error_rate=args.error_rate, burst=args.burst, slow_rate=args.slow_rate, slow_delay=args.slow_delay)
+
+
+def seed_import_folder(import_dir, base_url):
+    # saved view pages, as if downloaded from the browser, their download links point at the stand-in
+    os.makedirs(import_dir, exist_ok=True)
+    with app.test_request_context(base_url=base_url):
+        for sid in corpus['imports']:
+            with open(Path(import_dir) / f'{sid}.html', 'w') as fh:
+                fh.write(view_html(sid))
+
+
+def point_faves_get(work_dir, base_url, rate_delay, retry_delay):
+    faves_get.FA_BASE = base_url
+    faves_get.DB_FAVES = str(work_dir / 'favourites.db')
+    faves_get.DB_PAGES = str(work_dir / 'pages.db')
+    faves_get.DB_MEDIA = str(work_dir / 'file_index.db')
+    faves_get.MEDIA_DIR = work_dir / 'media'
+    faves_get.IMPORT_DIR = f'{work_dir / "download_import"}/'
+    faves_get.NOTIFY_URL = f'{base_url}/add_posts'
+    faves_get.IMPORT_SETTLE = 0  # the import folder is seeded right before the run
+    faves_get.session = requests.session()
+    fugsy_lib.rate_delay = rate_delay
+    fugsy_lib.retry_delay = retry_delay
+
+
+def report(elapsed, work_dir):
+    total = sum(stats['requests'].values())
+    logging.info(f'Wall time {elapsed:,.2f}s, {total:,} requests, {total / elapsed:,.1f} req/s')
+    for kind, n in sorted(stats['requests'].items()):
+        logging.info(f'  {kind:<12}{n:>8,}')
+    
+    logging.info(f'Injected {stats["errors"]:,} 5xx and {stats["slow"]:,} slow responses, {stats["notified"]:,} posts notified')
+    
+    stored = {}
+    for db, table in (('favourites.db', 'faves'), ('pages.db', 'pages'), ('file_index.db', 'files')):
+        with sqlite3.connect(work_dir / db) as conn:
+            stored[table] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    
+    logging.info(f'Stored {stored}, expected {len(corpus["faves"]):,} faves and {len(corpus["faves"]) + len(corpus["imports"]):,} pages and files')
+
+
+def run_bench(args):
+    configure(args)
+    server = start_server(args.host, args.port)
+    base_url = f'http://{args.host}:{server.server_port}'
+    
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='crawl_bench_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    point_faves_get(work_dir, base_url, args.rate_delay, args.retry_delay)
+    seed_import_folder(faves_get.IMPORT_DIR, base_url)
+    
+    faves_get.create_database()
+    logging.info(f'Crawling {len(corpus["faves"]):,} faves and {len(corpus["imports"]):,} imports from {base_url} into {work_dir}')
+    
+    start = time.time()
+    try:
+        faves_get.main(reconcile=args.reconcile)
+    finally:
+        elapsed = time.time() - start
+        server.shutdown()
+    
+    report(elapsed, work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local FA stand-in and faves_get throughput benchmark.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    parser.add_argument('--posts', type=int, default=200, help='Posts in the favourites listing')
+    parser.add_argument('--imports', type=int, default=5, help='Saved pages in the import folder')
+    parser.add_argument('--per-page', type=int, default=PER_PAGE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Chance a request starts a 5xx burst')
+    parser.add_argument('--burst', type=int, default=3, help='5xx responses per burst')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Chance a response is delayed')
+    parser.add_argument('--slow-delay', type=float, default=1.0, help='Seconds a slow response is delayed')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    subparsers.add_parser('serve')
+    
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--work-dir', help='Where the databases and media go, defaults to a temp dir')
+    run_parser.add_argument('--rate-delay', type=float, default=0.0, help='fugsy_lib.rate_delay for the run')
+    run_parser.add_argument('--retry-delay', type=float, default=0.05, help='fugsy_lib.retry_delay for the run')
+    run_parser.add_argument('--reconcile', action='store_true', help='Run the full reconciliation crawl')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'serve':
+        config_logger('crawl_bench')
+        configure(args)
+        app.run(host=args.host, port=args.port or 6994, threaded=True)
+    elif args.command == 'run':
+        config_logger('crawl_bench')
+        run_bench(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
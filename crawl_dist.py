@@ -0,0 +1,435 @@
+# distributed crawl
+# one coordinator owns the databases, workers on other machines do the fetching
+
+# coordinator:
+#  1. queue a post job per fave without a stored page, a media job per fave without media
+#  2. hand out batches of jobs as leases, a lease not heartbeated in time goes back in the queue
+#  3. workers send back page and media bytes, the coordinator does every db write
+#  4. stored posts are passed to tell_added in batches
+# worker:
+#  1. lease a batch, fetch each job with its own account and rate limit
+#  2. heartbeat the leases it holds, report every job as done or failed
+# local: coordinator plus several worker processes on this machine, for testing
+
+import argparse
+import io
+import socket
+import threading
+from multiprocessing import Process
+
+from flask import Flask, request, jsonify
+
+import faves_get
+from fugsy_lib import *
+from fa_common import BeautifulSoup, find_download_container, download_url_from_container
+
+DB_JOBS = '/agic/fugsy/db/jobs.db'
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 60
+MAX_ATTEMPTS = 3
+REFILL_SECONDS = 600
+NOTIFY_SECONDS = 30
+
+app = Flask(__name__)
+
+# every db write on the coordinator goes through this lock
+write_lock = threading.Lock()
+last_refill = [0]
+
+# sids stored since the last notify, sent in batches by notify_loop
+notify_pending = set()
+notify_lock = threading.Lock()
+
+
+JOBS_MIGRATIONS = [
+    # download_url: taken from the page when its post job is stored, so the media job needn't fetch it again
+    # note: why a done job doesn't have the data refill_jobs looks for, so it isn't requeued
+    (1, 'jobs.download_url', add_columns('jobs', ('download_url', 'TEXT'), ('note', 'TEXT'))),
+]
+
+
+def init_jobs_db():
+    with sqlite3.connect(DB_JOBS) as conn:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                sid INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at DATETIME,
+                UNIQUE(kind, sid)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, lease_expires)')
+        conn.commit()
+        run_migrations(conn, JOBS_MIGRATIONS)
+
+
+def refill_jobs():
+    # only queue what isn't stored yet, done jobs are requeued if their data went missing,
+    # media stored without a files row (not an image) is noted and left alone
+    now = datetime.utcnow()
+    queued = 0
+    with sqlite3.connect(DB_JOBS) as conn:
+        for kind, db_file, table in (('post', faves_get.DB_PAGES, 'pages'), ('media', faves_get.DB_MEDIA, 'files')):
+            for sid in faves_get.find_missing_posts(db_file, table, batch_size=5000):
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, sid, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(kind, sid) DO UPDATE SET state = 'pending', attempts = 0, updated_at = excluded.updated_at "
+                    "WHERE state = 'done' AND jobs.note IS NULL",
+                    (kind, sid, now)
+                )
+                queued += cursor.rowcount
+        
+        conn.commit()
+    
+    last_refill[0] = time.time()
+    logging.info(f'Queued {queued:,} jobs')
+    return queued
+
+
+def reclaim_expired(conn):
+    cursor = conn.execute(
+        "UPDATE jobs SET state = 'pending', worker = NULL WHERE state = 'leased' AND lease_expires < ?",
+        (time.time(), )
+    )
+    if cursor.rowcount:
+        logging.warning(f'Reclaimed {cursor.rowcount:,} expired leases')
+
+
+def lease_jobs(worker, count):
+    with write_lock, sqlite3.connect(DB_JOBS) as conn:
+        reclaim_expired(conn)
+        rows = conn.execute(
+            "SELECT id, kind, sid, download_url FROM jobs WHERE state = 'pending' ORDER BY kind DESC, sid LIMIT ?",
+            (count, )
+        ).fetchall()
+        
+        expires = time.time() + LEASE_SECONDS
+        conn.executemany(
+            "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+            [(worker, expires, datetime.utcnow(), job_id) for job_id, _, _, _ in rows]
+        )
+        conn.commit()
+    
+    jobs = []
+    for job_id, kind, sid, download_url in rows:
+        job = {'id': job_id, 'kind': kind, 'sid': sid, 'download_url': None}
+        if kind == 'media':
+            job['download_url'] = download_url or faves_get.read_download_url(sid)
+        
+        jobs.append(job)
+    
+    return jobs
+
+
+def job_owner(conn, job_id):
+    return conn.execute("SELECT kind, sid, state, worker FROM jobs WHERE id = ?", (job_id, )).fetchone()
+
+
+def finish_job(conn, job_id, ok, note=None):
+    if ok:
+        conn.execute(
+            "UPDATE jobs SET state = 'done', worker = NULL, note = ?, updated_at = ? WHERE id = ?",
+            (note, datetime.utcnow(), job_id)
+        )
+        return
+    
+    conn.execute(
+        "UPDATE jobs SET attempts = attempts + 1, worker = NULL, updated_at = ?, "
+        "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE id = ?",
+        (datetime.utcnow(), MAX_ATTEMPTS, job_id)
+    )
+
+
+@app.route('/lease', methods=['POST'])
+def lease():
+    body = request.get_json()
+    jobs = lease_jobs(body['worker'], int(body.get('count', 10)))
+    if not jobs and time.time() - last_refill[0] > REFILL_SECONDS:
+        with write_lock:
+            refill_jobs()
+        jobs = lease_jobs(body['worker'], int(body.get('count', 10)))
+    
+    return jsonify({'jobs': jobs, 'lease_seconds': LEASE_SECONDS})
+
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    body = request.get_json()
+    job_ids = [int(x) for x in body.get('jobs', [])]
+    with write_lock, sqlite3.connect(DB_JOBS) as conn:
+        conn.executemany(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            [(time.time() + LEASE_SECONDS, job_id, body['worker']) for job_id in job_ids]
+        )
+        conn.commit()
+    
+    return jsonify({'ok': True})
+
+
+@app.route('/complete', methods=['POST'])
+def complete():
+    job_id = int(request.form['job'])
+    worker = request.form['worker']
+    ok = request.form.get('status') == 'ok'
+    page = decompress(request.files['page'].read(), encoding=None) if 'page' in request.files else None
+    media = request.files['media'].read() if 'media' in request.files else None
+    note = None
+    
+    # decoding and hashing the image is the slow part, only the writes are serialized
+    values = None
+    if ok and media is not None:
+        values = fingerprint_image(io.BytesIO(media), faves_get.FINGERPRINT_COLUMNS)
+    
+    with write_lock, sqlite3.connect(DB_JOBS) as conn:
+        row = job_owner(conn, job_id)
+        if not row:
+            return jsonify({'error': f'unknown job {job_id}'}), 404
+        
+        kind, sid, state, owner = row
+        if state != 'leased' or owner != worker:
+            # lease expired and went to someone else, their result will be used
+            return jsonify({'error': f'job {job_id} is not leased to {worker}'}), 409
+        
+        if ok:
+            try:
+                if page is not None:
+                    faves_get.store_post_desc(sid, page)
+                
+                if kind == 'media':
+                    # done only once the bytes are written
+                    ok = media is not None and faves_get.store_post_media(
+                        sid, request.form['download_url'], [media], values
+                    )
+                    if ok and values['hash'] is None:
+                        note = 'not hashed'
+            except Exception as e:
+                logging.error(f'Storing {kind} {sid} from {worker} failed: {e}')
+                ok = False
+        
+        finish_job(conn, job_id, ok, note)
+        conn.commit()
+    
+    if ok and kind == 'post' and page is not None:
+        container = find_download_container(BeautifulSoup(page, 'html.parser'))
+        download_url = download_url_from_container(container) if container else None
+        if download_url:
+            with write_lock, sqlite3.connect(DB_JOBS) as conn:
+                conn.execute(
+                    "UPDATE jobs SET download_url = ? WHERE kind = 'media' AND sid = ?", (download_url, sid)
+                )
+                conn.commit()
+    
+    if ok:
+        with notify_lock:
+            notify_pending.add(sid)
+    
+    logging.info(f'{worker}: {kind} {sid} {"done" if ok else "failed"}')
+    return jsonify({'ok': ok})
+
+
+@app.route('/status', methods=['GET'])
+def status():
+    with sqlite3.connect(DB_JOBS) as conn:
+        rows = conn.execute("SELECT kind, state, COUNT(*) FROM jobs GROUP BY kind, state").fetchall()
+    
+    return jsonify([{'kind': kind, 'state': state, 'count': count} for kind, state, count in rows])
+
+
+def notify_loop():
+    # tell_added for everything stored through the coordinator, like check_posts does for a local run
+    while True:
+        time.sleep(NOTIFY_SECONDS)
+        with notify_lock:
+            added = set(notify_pending)
+            notify_pending.clear()
+        
+        try:
+            faves_get.tell_added(added)
+            faves_get.flush_stages()
+        except Exception as e:
+            logging.error(f'Notify failed: {e}')
+
+
+def run_coordinator(host, port):
+    faves_get.create_database()
+    init_jobs_db()
+    with write_lock:
+        refill_jobs()
+    
+    threading.Thread(target=notify_loop, daemon=True).start()
+    app.run(host=host, port=port, threaded=True)
+
+
+# --- worker ---
+
+def fetch_page(sess, sid):
+    response = session_get(f'{faves_get.FA_BASE}/view/{sid}', s=sess)
+    if response.status_code != 200:
+        raise ValueError(f'page for {sid} gave {response.status_code}')
+    
+    return response.content
+
+
+def run_job(sess, job):
+    files = {}
+    data = {}
+    sid = job['sid']
+    
+    if job['kind'] == 'post':
+        files['page'] = compress(fetch_page(sess, sid), encoding=None)
+        return data, files
+    
+    full_url = job['download_url']
+    if not full_url:
+        content = fetch_page(sess, sid)
+        files['page'] = compress(content, encoding=None)
+        container = find_download_container(BeautifulSoup(content, 'html.parser'))
+        full_url = download_url_from_container(container) if container else None
+        if not full_url:
+            raise ValueError(f'no download link for {sid}')
+    
+    response = session_get(full_url, s=sess)
+    if response.status_code != 200:
+        raise ValueError(f'media for {sid} gave {response.status_code}')
+    
+    data['download_url'] = full_url
+    files['media'] = response.content
+    return data, files
+
+
+def coordinator_post(url, **kwargs):
+    # a coordinator restart or a network blip shouldn't end the worker, keep trying like session_get does
+    while True:
+        try:
+            response = requests.post(url, **kwargs)
+            if response.status_code < 500:
+                return response
+            
+            logging.info(f'Coordinator gave {response.status_code}, waiting ({url})')
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Coordinator unreachable, waiting ({url}): {e}')
+        
+        time.sleep(retry_delay)
+
+
+def heartbeat_loop(coordinator, name, held, held_lock, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        with held_lock:
+            job_ids = list(held)
+        
+        try:
+            requests.post(f'{coordinator}/heartbeat', json={'worker': name, 'jobs': job_ids}, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Heartbeat failed: {e}')
+
+
+def run_worker(coordinator, account, name=None, batch=10, idle=30, once=False):
+    name = name or f'{socket.gethostname()}-{os.getpid()}'
+    if account == '-':
+        sess = requests.session()
+    else:
+        sess = create_session(account, 'cfg/')
+    
+    # shared with the heartbeat thread, only touched under held_lock
+    held = set()
+    held_lock = threading.Lock()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat_loop, args=(coordinator, name, held, held_lock, stop), daemon=True).start()
+    
+    done = 0
+    start = time.time()
+    try:
+        while True:
+            jobs = coordinator_post(f'{coordinator}/lease', json={'worker': name, 'count': batch}, timeout=60).json()['jobs']
+            if not jobs:
+                if once:
+                    break
+                
+                time.sleep(idle)
+                continue
+            
+            with held_lock:
+                held.update(job['id'] for job in jobs)
+            for job in jobs:
+                status = 'ok'
+                data, files = {}, {}
+                try:
+                    data, files = run_job(sess, job)
+                except Exception as e:
+                    logging.warning(f'{name}: {job["kind"]} {job["sid"]} failed: {e}')
+                    status = 'failed'
+                
+                data.update({'job': job['id'], 'worker': name, 'status': status})
+                coordinator_post(f'{coordinator}/complete', data=data, files=files, timeout=300)
+                with held_lock:
+                    held.discard(job['id'])
+                done += 1
+            
+            logging.info(f'{name}: {done:,} jobs, {done / (time.time() - start):.2f} jobs/s')
+    finally:
+        stop.set()
+
+
+def run_local(workers, accounts, host, port):
+    # coordinator in this process, workers as separate processes
+    threading.Thread(target=run_coordinator, args=(host, port), daemon=True).start()
+    time.sleep(2)
+    
+    coordinator = f'http://{host}:{port}'
+    procs = []
+    for i in range(workers):
+        account = accounts[i % len(accounts)]
+        proc = Process(target=run_worker, args=(coordinator, account, f'local-{i}'), kwargs={'once': True})
+        proc.start()
+        procs.append(proc)
+    
+    for proc in procs:
+        proc.join()
+    
+    logging.info(requests.get(f'{coordinator}/status').json())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed post and media crawl.')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    coord_parser = subparsers.add_parser('coordinator')
+    coord_parser.add_argument('--host', default='0.0.0.0')
+    coord_parser.add_argument('--port', type=int, default=6993)
+    
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('coordinator', help='e.g. http://crawlhost:6993')
+    worker_parser.add_argument('--account', default='', help="Secret suffix for create_session, '-' for no login")
+    worker_parser.add_argument('--name')
+    worker_parser.add_argument('--batch', type=int, default=10)
+    worker_parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+    
+    local_parser = subparsers.add_parser('local')
+    local_parser.add_argument('--workers', type=int, default=3)
+    local_parser.add_argument('--accounts', default='-', help='Comma separated, assigned round robin')
+    local_parser.add_argument('--host', default='127.0.0.1')
+    local_parser.add_argument('--port', type=int, default=6993)
+    
+    args = parser.parse_args()
+    
+    if args.command == 'coordinator':
+        config_logger('crawl_coordinator')
+        run_coordinator(args.host, args.port)
+    elif args.command == 'worker':
+        config_logger('crawl_worker')
+        run_worker(args.coordinator, args.account, args.name, args.batch, once=args.once)
+    elif args.command == 'local':
+        config_logger('crawl_local')
+        run_local(args.workers, args.accounts.split(','), args.host, args.port)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
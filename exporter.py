@@ -0,0 +1,334 @@
+# columnar exporter
+# write parquet/arrow snapshots of posts, faves and files for analytics
+
+# 1. make sure the change log triggers exist in each live db
+# 2. first run: export every row, afterwards only rows logged since the last run
+# 3. write hive partitioned files, export/<table>/snapshot=<ts>/bucket=<n>/
+# 4. remember the last exported change per table in export/state.json
+
+# a deleted row is exported as a tombstone: deleted is true and only its key columns are set,
+# the log holds one entry per key so a delta never has both a tombstone and a row for the same key
+
+import argparse
+import json
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from fugsy_lib import *
+from faves_get import DB_FAVES, DB_MEDIA
+
+EXPORT_DIR = Path('export')
+CHUNK_SIZE = 100_000
+BUCKET_SIZE = 1_000_000  # sids per partition
+
+TABLES = {
+    'posts': {
+        'db': DB_FAVES,
+        'columns': ['id', 'rating', 'thumbnail_url', 'tags', 'title', 'user', 'display_name', 'description'],
+        'key': ['id'],
+        'bucket': 'id',
+        'schema': pa.schema([
+            ('id', pa.int64()),
+            ('rating', pa.string()),
+            ('thumbnail_url', pa.string()),
+            ('tags', pa.list_(pa.string())),
+            ('title', pa.string()),
+            ('user', pa.string()),
+            ('display_name', pa.string()),
+            ('description', pa.string()),
+        ]),
+    },
+    'faves': {
+        'db': DB_FAVES,
+        'columns': ['user', 'sid'],
+        'key': ['user', 'sid'],
+        'bucket': 'sid',
+        'schema': pa.schema([
+            ('user', pa.string()),
+            ('sid', pa.int64()),
+        ]),
+    },
+    'files': {
+        'db': DB_MEDIA,
+        'columns': ['id', 'path', 'hash'],
+        'key': ['id'],
+        'bucket': 'id',
+        'schema': pa.schema([
+            ('id', pa.int64()),
+            ('path', pa.string()),
+            ('hash', pa.uint64()),
+        ]),
+    },
+}
+
+
+def check_table(table):
+    if table not in TABLES:
+        raise ValueError(f'Unknown table {table!r}, expected one of {", ".join(TABLES)}')
+
+
+def key_json(table, alias):
+    # the row's key columns as a json object, the same text for the same key whichever rowid holds it
+    return 'json_object(' + ', '.join(f"'{column}', {alias}.{column}" for column in TABLES[table]['key']) + ')'
+
+
+def upgrade_export_log(conn):
+    # logs from before row_key were unique on the rowid, which faves (no integer primary key) reuses
+    # after its last row is deleted, so an insert could replace a pending tombstone. rebuilt keyed
+    # on row_key, keeping seq so state.json still lines up
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(export_log)')]
+    if not columns or 'row_key' in columns:
+        return
+    
+    tombstone = 'l.tombstone' if 'tombstone' in columns else 'NULL'
+    last_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'export_log'").fetchone()
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    
+    conn.execute('BEGIN')
+    for table in TABLES:
+        for event in ('insert', 'update', 'rekey', 'delete'):
+            conn.execute(f'DROP TRIGGER IF EXISTS export_{table}_{event}')
+    
+    conn.execute('ALTER TABLE export_log RENAME TO export_log_old')
+    create_export_log(conn)
+    for table in TABLES:
+        if table not in tables:
+            continue
+        
+        # entries whose row is gone without a tombstone can't be keyed, they were exported as nothing anyway
+        conn.execute(f'''
+            INSERT INTO export_log (seq, tbl, row_key, row_id, tombstone)
+            SELECT l.seq, l.tbl, COALESCE({tombstone}, {key_json(table, 't')}), l.row_id, {tombstone}
+            FROM export_log_old l LEFT JOIN {table} t ON t.rowid = l.row_id AND {tombstone} IS NULL
+            WHERE l.tbl = ? AND ({tombstone} IS NOT NULL OR t.rowid IS NOT NULL)
+            ORDER BY l.seq
+        ''', (table, ))
+    
+    conn.execute('DROP TABLE export_log_old')
+    if last_seq:
+        conn.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'export_log'", (last_seq[0], )
+        )
+        conn.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'export_log', ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'export_log')", (last_seq[0], )
+        )
+    
+    conn.commit()
+    logging.info('Rebuilt export_log keyed on row_key')
+
+
+def create_export_log(conn):
+    # one entry per logical row, a newer change to the same key replaces it with a fresh seq.
+    # row_id finds the live row, tombstone holds the key of a deleted one
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            tombstone TEXT,
+            UNIQUE(tbl, row_key) ON CONFLICT REPLACE
+        )
+    ''')
+    
+
+def install_triggers(conn, table):
+    # every insert/update/delete lands in export_log with a fresh seq. an update that changes
+    # the key also leaves a tombstone for the old key
+    check_table(table)
+    upgrade_export_log(conn)
+    create_export_log(conn)
+    
+    new_key, old_key = key_json(table, 'NEW'), key_json(table, 'OLD')
+    for event in ('INSERT', 'UPDATE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS export_{table}_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO export_log (tbl, row_key, row_id) VALUES ('{table}', {new_key}, NEW.rowid);
+            END
+        ''')
+    
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS export_{table}_rekey
+        AFTER UPDATE ON {table} WHEN {old_key} IS NOT {new_key}
+        BEGIN
+            INSERT INTO export_log (tbl, row_key, row_id, tombstone) VALUES ('{table}', {old_key}, OLD.rowid, {old_key});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS export_{table}_delete
+        AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO export_log (tbl, row_key, row_id, tombstone) VALUES ('{table}', {old_key}, OLD.rowid, {old_key});
+        END
+    ''')
+    
+    conn.commit()
+
+
+def current_seq(conn, table):
+    row = conn.execute('SELECT MAX(seq) FROM export_log WHERE tbl = ?', (table, )).fetchone()
+    return row[0] or 0
+
+
+def convert_row(table, row):
+    row = dict(zip(TABLES[table]['columns'], row))
+    
+    if table == 'posts':
+        row['tags'] = row['tags'].split() if row['tags'] else []
+    
+    elif table == 'files' and row['hash'] is not None:
+        if isinstance(row['hash'], str):
+            row['hash'] = int(row['hash'], 16)
+        
+        row['hash'] = to_unsigned(row['hash'])
+    
+    row['deleted'] = False
+    return row
+
+
+def tombstone_row(table, tombstone):
+    row = dict.fromkeys(TABLES[table]['columns'])
+    row.update(json.loads(tombstone))
+    row['deleted'] = True
+    return row
+
+
+def iter_chunks(conn, table, since_seq=None, until_seq=None):
+    # a full snapshot walks the table in rowid order, a delta walks the log in seq order
+    columns = ', '.join(TABLES[table]['columns'])
+    last_key = -1 if since_seq is None else since_seq
+    
+    while True:
+        if since_seq is None:
+            cur = conn.execute(f'''
+                SELECT rowid, {columns} FROM {table}
+                WHERE rowid > ?
+                ORDER BY rowid LIMIT {CHUNK_SIZE}
+            ''', (last_key, ))
+        else:
+            # the live row must still hold the logged key, a row that's gone without a tombstone
+            # was deleted before the delete trigger existed
+            cur = conn.execute(f'''
+                SELECT l.seq, {', '.join('t.' + c for c in TABLES[table]['columns'])}, t.rowid IS NOT NULL, l.tombstone
+                FROM export_log l LEFT JOIN {table} t
+                    ON t.rowid = l.row_id AND l.tombstone IS NULL AND {key_json(table, 't')} = l.row_key
+                WHERE l.tbl = ? AND l.seq > ? AND l.seq <= ?
+                ORDER BY l.seq LIMIT {CHUNK_SIZE}
+            ''', (table, last_key, until_seq))
+        
+        rows = cur.fetchall()
+        if not rows:
+            break
+        
+        last_key = rows[-1][0]
+        if since_seq is None:
+            yield [convert_row(table, row[1:]) for row in rows]
+            continue
+        
+        chunk = []
+        for row in rows:
+            *values, found, tombstone = row[1:]
+            if tombstone is not None:
+                chunk.append(tombstone_row(table, tombstone))
+            elif found:
+                chunk.append(convert_row(table, values))
+        
+        if chunk:
+            yield chunk
+
+
+def write_chunk(table, rows, out_dir, chunk_no, fmt):
+    spec = TABLES[table]
+    for row in rows:
+        row['bucket'] = row[spec['bucket']] // BUCKET_SIZE
+    
+    schema = spec['schema'].append(pa.field('deleted', pa.bool_())).append(pa.field('bucket', pa.int64()))
+    data = pa.Table.from_pylist(rows, schema=schema)
+    
+    ds.write_dataset(
+        data,
+        out_dir,
+        format='parquet' if fmt == 'parquet' else 'ipc',
+        partitioning=['bucket'],
+        partitioning_flavor='hive',
+        basename_template=f'part-{chunk_no:05d}-{{i}}.{fmt}',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+
+def load_state():
+    fn = EXPORT_DIR / 'state.json'
+    if not fn.exists():
+        return {}
+    
+    with open(fn, 'r') as fh:
+        return json.load(fh)
+
+
+def save_state(state):
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = EXPORT_DIR / 'state.json.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh, indent=2)
+    
+    os.replace(tmp, EXPORT_DIR / 'state.json')
+
+
+def export_table(table, state, fmt='parquet', full=False):
+    check_table(table)
+    spec = TABLES[table]
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    table_state = state.get(table, {})
+    since_seq = None if full else table_state.get('seq')
+    
+    with sqlite3.connect(spec['db']) as conn:
+        install_triggers(conn, table)
+        until_seq = current_seq(conn, table)
+        
+        if since_seq is not None and since_seq >= until_seq:
+            logging.info(f'{table}: no changes since last snapshot')
+            return
+        
+        kind = 'full' if since_seq is None else 'delta'
+        out_dir = EXPORT_DIR / table / f'snapshot={stamp}'
+        start = time.time()
+        total = 0
+        
+        for chunk_no, rows in enumerate(iter_chunks(conn, table, since_seq, until_seq)):
+            write_chunk(table, rows, out_dir, chunk_no, fmt)
+            total += len(rows)
+    
+    elapsed = time.time() - start
+    logging.info(f'{table}: {kind} snapshot of {total:,} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)')
+    
+    table_state['seq'] = until_seq
+    table_state.setdefault('snapshots', []).append({
+        'snapshot': stamp, 'kind': kind, 'rows': total, 'format': fmt
+    })
+    state[table] = table_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export posts, faves and files to columnar snapshots.')
+    parser.add_argument('tables', nargs='*', default=list(TABLES), help='Tables to export')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--full', action='store_true', help='Ignore state and export every row')
+    args = parser.parse_args()
+    
+    unknown = [table for table in args.tables if table not in TABLES]
+    if unknown:
+        parser.error(f'unknown table {", ".join(unknown)}, expected one of {", ".join(TABLES)}')
+    
+    state = load_state()
+    for table in args.tables:
+        export_table(table, state, fmt=args.format, full=args.full)
+        save_state(state)
+
+
+if __name__ == '__main__':
+    config_logger('exporter')
+    main()
@@ -1,7 +1,40 @@
 import json
 import html
 import logging
-from bs4 import BeautifulSoup
+import re
+import hashlib
+from datetime import datetime
+
+from fugsy_lib import lazy_import
+
+bs4 = lazy_import('bs4')
+
+
+def BeautifulSoup(*args, **kwargs):
+    return bs4.BeautifulSoup(*args, **kwargs)
+
+
+# parts of a page that change on every request without the post changing
+VOLATILE_PATTERNS = [
+    (re.compile(rb'<script\b.*?</script>', re.S | re.I), b''),
+    (re.compile(rb'<!--.*?-->', re.S), b''),
+    (re.compile(rb'<div class="online-stats".*?</div>', re.S), b''),
+    (re.compile(rb'([?&]key=)[0-9a-zA-Z]+'), rb'\1'),
+    (re.compile(rb'(name="key"\s+value=")[^"]*'), rb'\1'),
+    (re.compile(rb'\s+'), b' '),
+]
+
+
+def normalize_page(content: bytes) -> bytes:
+    for pattern, repl in VOLATILE_PATTERNS:
+        content = pattern.sub(repl, content)
+    
+    return content.strip()
+
+
+def page_hash(content: bytes) -> bytes:
+    return hashlib.blake2b(normalize_page(content), digest_size=16).digest()
+
 
 def extract_submission_data(html_content):
     soup = BeautifulSoup(html_content, 'html.parser')
@@ -73,4 +106,107 @@ def extract_figure_info(html_content):
 
         extracted_data.append(data)
     
-    return extracted_data
\ No newline at end of file
+    return extracted_data
+
+
+def find_download_container(soup):
+    return soup.find('div', class_='aligncenter auto_link hideonfull1 favorite-nav')
+
+
+def download_url_from_container(container):
+    # Search for the Download link within the container
+    download_link = container.find('a', string='Download')
+    if download_link and download_link.has_attr('href'):
+        href = download_link['href']
+        return 'https:' + href if href.startswith('//') else href
+
+
+def parse_post_date(text):
+    # "Mar 5th, 2021 10:00 PM" or "Mar 5, 2021 10:00 PM"
+    text = re.sub(r'(\d+)(st|nd|rd|th)', r'\1', text.strip())
+    for fmt in ('%b %d, %Y %I:%M %p', '%B %d, %Y %I:%M %p', '%b %d, %Y %H:%M'):
+        try:
+            return datetime.strptime(text, fmt).isoformat()
+        except ValueError:
+            pass
+    
+    return text or None
+
+
+def extract_post_meta(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    data = {
+        'download_url': None,
+        'title': None,
+        'tags': [],
+        'rating': None,
+        'uploader': None,
+        'posted_at': None,
+    }
+    
+    container = find_download_container(soup)
+    if container:
+        data['download_url'] = download_url_from_container(container)
+    
+    # modern theme first, classic theme as fallback
+    title = soup.select_one('div.submission-title h2') or soup.select_one('div.classic-submission-title h2')
+    if title:
+        data['title'] = title.get_text(strip=True) or None
+    
+    tags = soup.select('section.tags-row span.tags a') or soup.select('#keywords a')
+    data['tags'] = [tag.get_text(strip=True) for tag in tags if tag.get_text(strip=True)]
+    
+    rating = soup.select_one('div.rating span.rating-box')
+    if rating:
+        data['rating'] = rating.get_text(strip=True).lower() or None
+    else:
+        rating = soup.find('img', alt=re.compile(r'rating$', re.I))
+        if rating:
+            data['rating'] = rating['alt'].split()[0].lower()
+    
+    uploader = soup.select_one('div.submission-id-sub-container a[href^="/user/"]') or soup.select_one('div.classic-submission-title a[href^="/user/"]')
+    if uploader:
+        data['uploader'] = uploader['href'].strip('/').split('/')[-1] or None
+    
+    posted = soup.find('span', class_='popup_date')
+    if posted:
+        data['posted_at'] = parse_post_date(posted.get('title') or posted.get_text())
+    
+    return data
+
+
+# regions of a view page that anything reads back, everything else is dropped by slim_page
+SLIM_SELECTORS = [
+    'meta[property="og:url"]',
+    'title',
+    'script#js-submissionData',
+    'div.submission-id-sub-container',
+    'div.classic-submission-title',
+    'div.rating',
+    'section.tags-row',
+    '#keywords',
+    'div.submission-description',
+    'span.popup_date',
+]
+
+
+def slim_page(content: bytes) -> bytes:
+    soup = BeautifulSoup(content, 'html.parser')
+    found = [el for selector in SLIM_SELECTORS for el in soup.select(selector)]
+    found += soup.find_all('img', alt=re.compile(r'rating$', re.I))
+    container = find_download_container(soup)
+    if not container:
+        # not a page we know the layout of, keep all of it
+        return content
+    
+    found.append(container)
+    
+    # skip anything already inside a kept region, keep document order
+    kept = set(map(id, found))
+    regions = [el for el in found if not any(id(parent) in kept for parent in el.parents)]
+    order = {id(el): i for i, el in enumerate(soup.find_all(True))}
+    regions = sorted({id(el): el for el in regions}.values(), key=lambda el: order[id(el)])
+    
+    head = ''.join(str(el) for el in regions if el.name in ('meta', 'title'))
+    body = '\n'.join(str(el) for el in regions if el.name not in ('meta', 'title'))
+    return f'<!DOCTYPE html>\n<html><head><meta charset="utf-8">{head}</head><body>\n{body}\n</body></html>'.encode('utf-8')
@@ -3,6 +3,9 @@
 # 1. get faves page
 # 2. write faves to db
 # 3. if no new faves, break
+#  (--reconcile walks every page instead, resumable, and marks unfaved posts removed,
+#   --allow-mass-removal lets it remove more than RECONCILE_MAX_REMOVED of the stored faves)
+# (--watch-imports only keeps importing saved pages from download_import/)
 
 # 4. for all new faves
 #  5. go to page
@@ -11,12 +14,80 @@
 
 from fugsy_lib import *
 from fa_common import *
+from pages_store import init_pages_store, connect_page_db, existing_ids, is_partitioned, page_db_paths
 from typing import List, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import io
 
+FA_BASE = 'https://www.furaffinity.net'
 DB_FAVES = '/agic/fugsy/db/favourites,db'
-DB_PAGES = '/agic/fugsy/db/pages.db'
+DB_PAGES = '/agic/fugsy/db/pages.db'  # a directory here means pages partitioned by sid range, see pages_store
+DB_PAGES_COLD = '/agic/fugsy/db/pages_cold.db'  # full pages set aside by `pages_maint.py slim`
 DB_MEDIA = '/agic/media_idx/file_index.db'
 MEDIA_DIR = Path('/agic/media_idx')
+IMPORT_DIR = 'download_import/'
+IMPORT_WORKERS = 4  # concurrent media downloads for imported pages, all share the rate limit
+IMPORT_POLL = 10  # seconds between scans of IMPORT_DIR with --watch-imports
+IMPORT_SETTLE = 2  # files modified more recently than this may still be downloading
+NOTIFY_URL = 'http://0.0.0.0:6992/add_posts'
+FINGERPRINT_COLUMNS = ['hash', 'phash', 'dhash', 'chash']  # computed from one decode per file
+SLIM_PAGES = False  # store only the page regions anything reads back
+PRESCREEN_THUMBNAILS = False  # hash the thumbnail first and defer likely duplicates
+PRESCREEN_DISTANCE = 2
+STAGE_FLUSH = 500  # buffered post_timeline marks written in one transaction
+RECONCILE_MAX_REMOVED = 0.25  # share of stored faves a reconcile may mark removed without --allow-mass-removal
+
+# hash index of stored media, loaded on first prescreen and kept up to date by fetch_post_media
+media_index = {}
+media_index_lock = threading.Lock()
+
+# the og:url meta tag of a saved view page, attributes in either order
+OG_URL_TAG = re.compile(rb'<meta\b[^>]*?property=["\']og:url["\'][^>]*>', re.I)
+VIEW_SID = re.compile(rb'/view/(\d+)')
+
+# saved pages that couldn't be imported, so watching doesn't retry them every scan
+import_failed = set()
+
+# table -> SidBitmap of stored ids, loaded by load_sid_bitmaps and kept up to date by the writers,
+# a table that isn't loaded falls back to querying its db. other processes (crawl_dist, a second
+# faves_get) store rows too, so a miss is checked against the db before it's trusted, see bitmap_exists
+sid_bitmaps = {}
+
+# (stage, sid, time) marks waiting to be written to post_timeline, see flush_stages
+stage_marks = []
+stage_lock = threading.Lock()
+
+FAVES_MIGRATIONS = [
+    # set by a reconciliation crawl when a fave is no longer on the user's favourites
+    (1, 'faves.removed_at', add_columns('faves', ('removed_at', 'DATETIME'))),
+    # where an unfinished reconciliation crawl got to, and what it has seen so far
+    (2, 'reconcile state', '''
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            user TEXT PRIMARY KEY,
+            path TEXT,
+            page INTEGER,
+            started_at DATETIME,
+            updated_at DATETIME
+        );
+        CREATE TABLE IF NOT EXISTS reconcile_seen (
+            user TEXT NOT NULL,
+            sid INTEGER NOT NULL,
+            UNIQUE(user, sid)
+        );
+    '''),
+    # when each post first reached each stage of the pipeline, see mark_stage and pipeline_report
+    (3, 'post_timeline', '''
+        CREATE TABLE IF NOT EXISTS post_timeline (
+            sid INTEGER PRIMARY KEY,
+            discovered_at DATETIME,
+            page_at DATETIME,
+            media_at DATETIME,
+            hashed_at DATETIME,
+            notified_at DATETIME
+        );
+    '''),
+]
 
 def create_database():
     with sqlite3.connect(DB_FAVES) as conn:
@@ -48,6 +119,10 @@ def create_database():
         ''')
         
         conn.commit()
+        run_migrations(conn, FAVES_MIGRATIONS)
+    
+    init_pages_store(DB_PAGES)
+    init_media_db(DB_MEDIA)
     
 #    with sqlite3.connect(DB_PAGES) as conn:        
 #        conn.execute('''
@@ -76,11 +151,76 @@ def insert_faves(user, posts):
                 # already liked → ignore
                 pass
         
+        mark_stage('discovered', new_insertions, conn)
         conn.commit()
     
     return new_insertions
 
 
+def stage_query(stage):
+    # only the first time counts, a refetched page or a repeated notify keeps the original time
+    column = f'{stage}_at'
+    return f'''
+        INSERT INTO post_timeline (sid, {column}) VALUES (?, ?)
+        ON CONFLICT(sid) DO UPDATE SET {column} = COALESCE({column}, excluded.{column})
+    '''
+
+
+def mark_stage(stage, sids, conn=None):
+    # written with the caller's transaction when there is one, otherwise buffered with the time it
+    # happened and written a batch at a time, so the per post path doesn't commit to favourites.db
+    now = datetime.utcnow()
+    rows = [(int(sid), now) for sid in sids]
+    if not rows:
+        return
+    
+    if conn is not None:
+        conn.executemany(stage_query(stage), rows)
+        return
+    
+    with stage_lock:
+        stage_marks.extend((stage, sid, at) for sid, at in rows)
+        full = len(stage_marks) >= STAGE_FLUSH
+    
+    if full:
+        flush_stages()
+
+
+def flush_stages():
+    with stage_lock:
+        marks = stage_marks[:]
+        del stage_marks[:]
+    
+    if not marks:
+        return
+    
+    by_stage = {}
+    for stage, sid, at in marks:
+        by_stage.setdefault(stage, []).append((sid, at))
+    
+    with sqlite3.connect(DB_FAVES, timeout=30) as conn:
+        for stage, rows in by_stage.items():
+            conn.executemany(stage_query(stage), rows)
+        conn.commit()
+
+
+# the exit() calls on fetch failures and uncaught exceptions would otherwise drop the buffered marks
+atexit.register(flush_stages)
+
+
+def mark_notified(sids):
+    # new faves are announced before they're fetched, so the stage is the first notify after the
+    # media is in, whether or not it could be hashed
+    flush_stages()
+    now = datetime.utcnow()
+    with sqlite3.connect(DB_FAVES, timeout=30) as conn:
+        conn.executemany(
+            'UPDATE post_timeline SET notified_at = ? WHERE sid = ? AND media_at IS NOT NULL AND notified_at IS NULL',
+            [(now, int(sid)) for sid in sids]
+        )
+        conn.commit()
+
+
 def save_to_database(figures_data):
     new_insertions = 0
     
@@ -97,6 +237,7 @@ def save_to_database(figures_data):
                 INSERT OR REPLACE INTO posts (id, rating, thumbnail_url, tags, title, user, display_name, description)
                 VALUES (?, ?, ?, ?, ?, ?, ? ,?)
             ''', (data.get('id'), data.get('rating'), data.get('thumbnail_url'), ' '.join(data.get('tags')), data.get('title'), data.get('user'), data.get('display_name'), data.get('description')))
+            mark_stored('posts', int(data['id']))
             
             if 'user' not in data:
                 logging.warning(f'wtf no user {data}')
@@ -116,7 +257,7 @@ def crawl_favourites(target):
     all_new_posts = []
     
     while path:
-        response = session_get('https://www.furaffinity.net' + path, s=session)
+        response = session_get(FA_BASE + path, s=session)
         html_content = response.text
         
         figures_data = extract_figure_info(html_content)
@@ -155,34 +296,185 @@ def crawl_favourites(target):
     return set(all_new_posts)
 
 
+def reconcile_favourites(target, allow_mass_removal=False):
+    # walk every page, checkpointing after each, then mark faves that weren't seen as removed.
+    # the walk only ends on a page with a listing and no Next button, anything else (logged out,
+    # a system message page) stops it with the cursor left on that page for a rerun
+    now = datetime.utcnow()
+    with sqlite3.connect(DB_FAVES) as conn:
+        row = conn.execute('SELECT path, page FROM crawl_state WHERE user = ?', (target, )).fetchone()
+        if row:
+            path, page = row
+            logging.info(f'Resuming reconciliation of {target} at page {page:,}')
+        else:
+            path, page = f'/favorites/{target}/', 1
+            conn.execute('DELETE FROM reconcile_seen WHERE user = ?', (target, ))
+            conn.execute(
+                'INSERT INTO crawl_state (user, path, page, started_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (target, path, page, now, now)
+            )
+        
+        known = set(x[0] for x in conn.execute('SELECT sid FROM faves WHERE user = ?', (target, )))
+        conn.commit()
+    
+    all_new_posts = set()
+    while path:
+        response = session_get(FA_BASE + path, s=session)
+        if response.status_code != 200:
+            logging.error(f'Page {page:,} gave {response.status_code}, stopping, rerun to resume')
+            return all_new_posts
+        
+        html_content = response.text
+        soup = BeautifulSoup(html_content, 'html.parser')
+        if soup.find('section', class_='gallery') is None:
+            logging.error(f'Page {page:,} has no favourites listing, stopping, rerun to resume')
+            return all_new_posts
+        
+        figures_data = extract_figure_info(html_content)
+        save_to_database(figures_data)
+        
+        posts = set(int(x['id']) for x in figures_data)
+        page_new_posts = posts - known
+        known |= page_new_posts
+        all_new_posts |= page_new_posts
+        
+        path = None
+        next_button = soup.find("button", string="Next")
+        if next_button:
+            next_form = next_button.find_parent("form")
+            if next_form and "action" in next_form.attrs:
+                path = next_form["action"]
+        
+        # the page's faves and the cursor past it commit together
+        with sqlite3.connect(DB_FAVES) as conn:
+            conn.executemany('INSERT OR IGNORE INTO reconcile_seen (user, sid) VALUES (?, ?)', [(target, sid) for sid in posts])
+            conn.executemany('INSERT OR IGNORE INTO faves (user, sid) VALUES (?, ?)', [(target, sid) for sid in page_new_posts])
+            mark_stage('discovered', page_new_posts, conn)
+            conn.execute(
+                'UPDATE crawl_state SET path = ?, page = ?, updated_at = ? WHERE user = ?',
+                (path, page + 1, datetime.utcnow(), target)
+            )
+            conn.commit()
+        
+        logging.debug(f'Page {page:,}: contained {len(posts):,} posts, {len(page_new_posts):,} new posts.')
+        page += 1
+    
+    with sqlite3.connect(DB_FAVES) as conn:
+        seen = conn.execute('SELECT COUNT(*) FROM reconcile_seen WHERE user = ?', (target, )).fetchone()[0]
+        if not seen and known:
+            # an empty listing is far more likely a logged out session than everything unfaved
+            logging.error(f'Saw no faves for {target}, not marking {len(known):,} stored faves as removed')
+            return all_new_posts
+        
+        active, removing = conn.execute(
+            'SELECT COUNT(*), COUNT(*) FILTER (WHERE sid NOT IN (SELECT sid FROM reconcile_seen WHERE user = ?)) '
+            'FROM faves WHERE user = ? AND removed_at IS NULL',
+            (target, target)
+        ).fetchone()
+        if removing > RECONCILE_MAX_REMOVED * active and not allow_mass_removal:
+            # the walk is kept, rerunning with --allow-mass-removal marks them without walking again
+            logging.error(
+                f'Reconciling {target} would mark {removing:,} of {active:,} faves removed, refusing, '
+                f'rerun with --allow-mass-removal if that is right'
+            )
+            return all_new_posts
+        
+        now = datetime.utcnow()
+        removed = conn.execute(
+            'UPDATE faves SET removed_at = ? WHERE user = ? AND removed_at IS NULL '
+            'AND sid NOT IN (SELECT sid FROM reconcile_seen WHERE user = ?)',
+            (now, target, target)
+        ).rowcount
+        restored = conn.execute(
+            'UPDATE faves SET removed_at = NULL WHERE user = ? AND removed_at IS NOT NULL '
+            'AND sid IN (SELECT sid FROM reconcile_seen WHERE user = ?)',
+            (target, target)
+        ).rowcount
+        conn.execute('DELETE FROM reconcile_seen WHERE user = ?', (target, ))
+        conn.execute('DELETE FROM crawl_state WHERE user = ?', (target, ))
+        conn.commit()
+    
+    logging.info(
+        f'Reconciled {target} over {page - 1:,} pages: {seen:,} faves, {len(all_new_posts):,} new, '
+        f'{removed:,} removed, {restored:,} re-faved'
+    )
+    return all_new_posts
+
+
+def sid_from_saved_page(content: bytes):
+    # only the head is needed, og:url comes well before the body
+    tag = OG_URL_TAG.search(content, 0, 65536)
+    match = VIEW_SID.search(tag.group(0)) if tag else None
+    return int(match.group(1)) if match else None
+
+
+def import_media(sid, html_content):
+    # a saved page is an explicit request for the post, so no prescreening
+    try:
+        return bool(fetch_post_media(sid, html_content, prescreen=False))
+    except (Exception, SystemExit) as e:
+        # fetch_post_media exits on repeated failures, that shouldn't end the whole import
+        logging.error(f'Import media for {sid} failed: {e!r}')
+        return False
+
+
 def check_import_folder():
-    import_path = 'download_import/'
+    # store each saved page as it is and queue its media, pages are removed once media is stored
     added = set()
-    
-    for fn in os.listdir(import_path):
-        with open(import_path + fn, 'rb') as fh:
-            html_content = str(fh.read())
+    saved = []
+    pending = []
+    settled = time.time() - IMPORT_SETTLE
+    preload(bs4, Image, imagehash, requests)
+    
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        for entry in sorted(os.scandir(IMPORT_DIR), key=lambda e: e.name):
+            if not entry.is_file() or entry.path in import_failed or entry.stat().st_mtime > settled:
+                continue
         
-        soup = BeautifulSoup(html_content, "html.parser")
-        meta_tag = soup.find("meta", {"property": "og:url"})
+            with open(entry.path, 'rb') as fh:
+                content = fh.read()
 
-        if not meta_tag:
-            logging.warning(f'No sid in file: {fn}')
-            continue
+            sid = sid_from_saved_page(content)
+            if sid is None:
+                logging.warning(f'No sid in file: {entry.name}')
+                import_failed.add(entry.path)
+                continue
         
-        url = meta_tag["content"]
-        # Use regex to capture the digits before the trailing slash
-        match = re.search(r"/view/(\d+)/", url)
-        if not match:
-            logging.warning(f'No sid in file: {fn}')
-            continue
+            logging.info(f'Import sid: {sid}')
+            mark_stage('discovered', [sid])
+            store_post_desc(sid, content)
+            saved.append((entry.path, sid))
         
-        sid = int(match.group(1))
-        logging.info(f'Import sid: {sid}')
-        held_data = fetch_post_desc(sid)
-        fetch_post_media(sid, held_data)
-        added.add(sid)
-        os.remove(import_path + fn)
+        # one existence check for the whole folder, pages without media are read again to import it
+        stored = set(check_media_exists([sid for _, sid in saved]))
+        for path, sid in saved:
+            if sid in stored:
+                pending.append((path, sid, None))
+                continue
+            
+            with open(path, 'rb') as fh:
+                pending.append((path, sid, pool.submit(import_media, sid, fh.read())))
+        
+        for path, sid, future in pending:
+            if future is not None and not future.result():
+                import_failed.add(path)
+                continue
+            
+            added.add(sid)
+            os.remove(path)
+    
+    if added:
+        logging.info(f'Imported {len(added):,} posts: {sorted(added)}')
+    
+    return added
+
+
+def watch_import_folder(poll=IMPORT_POLL):
+    logging.info(f'Watching {IMPORT_DIR} every {poll}s')
+    while True:
+        tell_added(check_import_folder())
+        flush_stages()
+        time.sleep(poll)
 
 
 def common_check_exists(db_file: str, table: str, ids: List[int]) -> List[int]:
@@ -199,52 +491,211 @@ def common_check_exists(db_file: str, table: str, ids: List[int]) -> List[int]:
     return [row[0] for row in rows]
 
 
+def load_sid_bitmaps():
+    # one pass over each id column at startup, existence checks are bit lookups after this
+    start = time.time()
+    sources = {'posts': [DB_FAVES], 'pages': page_db_paths(DB_PAGES), 'files': [DB_MEDIA]}
+    for table, paths in sources.items():
+        sid_bitmaps[table] = load_sid_bitmap(paths, table)
+    
+    sizes = ', '.join(f'{len(bitmap):,} {table}' for table, bitmap in sid_bitmaps.items())
+    logging.info(f'Loaded sid bitmaps in {time.time() - start:,.2f}s: {sizes}')
+
+
+def mark_stored(table, sid):
+    if table in sid_bitmaps:
+        sid_bitmaps[table].add(sid)
+
+
+def lookup_stored(table, ids, chunk_size=500):
+    if table == 'pages':
+        return existing_ids(DB_PAGES, ids)
+    
+    db_file = {'posts': DB_FAVES, 'files': DB_MEDIA}[table]
+    found = []
+    for i in range(0, len(ids), chunk_size):
+        found += common_check_exists(db_file, table, ids[i:i + chunk_size])
+    
+    return found
+
+
+def bitmap_exists(table, ids):
+    # rows aren't removed so hits are final, misses may have been stored since the bitmap was loaded
+    bitmap = sid_bitmaps[table]
+    found = [sid for sid in ids if sid in bitmap]
+    misses = [sid for sid in ids if sid not in bitmap]
+    for sid in lookup_stored(table, misses):
+        bitmap.add(sid)
+        found.append(sid)
+    
+    return found
+
+
 def check_desc_exists(ids: List[int]) -> List[int]:
-    return common_check_exists(DB_PAGES, 'pages', ids)
+    if 'pages' in sid_bitmaps:
+        return bitmap_exists('pages', ids)
+    
+    return existing_ids(DB_PAGES, ids)
 
 
 def check_media_exists(ids: List[int]) -> List[int]:
-    return common_check_exists(DB_MEDIA, 'files', ids)
+    if 'files' in sid_bitmaps:
+        return bitmap_exists('files', ids)
+    
+    return lookup_stored('files', ids)
 
 
 def fetch_post_desc(sid):
     logging.info(f'Fetching description for {sid}')
-    response = session_get(f'https://www.furaffinity.net/view/{sid}', s=session)
+    response = session_get(f'{FA_BASE}/view/{sid}', s=session)
     
     if response.status_code != 200:
         logging.warning('Response was not 200, retrying...')
-        response = session_get(f'https://www.furaffinity.net/view/{sid}', s=session)
+        response = session_get(f'{FA_BASE}/view/{sid}', s=session)
         if response.status_code != 200:
             logging.error('Response still not 200, aborting...')
             exit()
     
     html_content = response.text
-    compressed = compress(response.content, encoding=None)
+    store_post_desc(sid, response.content)
+    
+    return html_content
+
+
+def store_post_desc(sid, content):
+    slim = None
+    if SLIM_PAGES:
+        slimmed = slim_page(content)
+        slim = int(slimmed is not content)
+        content = slimmed
+    
+    content_hash = page_hash(content)
+    encoding = detect_encoding(content)
+    now = datetime.utcnow()
     
-    with sqlite3.connect(DB_PAGES) as conn:
+    with connect_page_db(DB_PAGES, sid, write=True) as conn:
+        cursor = conn.execute('SELECT html, content_hash, created_at FROM pages WHERE id = ?', (sid, ))
+        row = cursor.fetchone()
+        
+        if row:
+            old_html, old_hash, old_created = row
+            old_content = decompress(old_html, encoding=None)
+            if old_hash is None:
+                old_hash = page_hash(old_content)
+            
+            if old_hash == content_hash:
+                logging.debug(f'Page for {sid} unchanged')
+                conn.execute(
+                    'UPDATE pages SET last_seen = ?, encoding = COALESCE(encoding, ?) WHERE id = ?',
+                    (now, encoding, sid)
+                )
+                return False
+            
+            # keep the old version as a delta against the new one
+            cursor = conn.execute('SELECT COALESCE(MAX(rev), 0) + 1 FROM page_revisions WHERE id = ?', (sid, ))
+            rev = cursor.fetchone()[0]
+            conn.execute(
+                "INSERT INTO page_revisions (id, rev, created_at, content_hash, delta) VALUES (?, ?, ?, ?, ?)",
+                (sid, rev, old_created, old_hash, delta_compress(old_content, content)),
+            )
+            logging.info(f'Page for {sid} changed, kept previous as revision {rev}')
+        
         conn.execute(
-            "INSERT OR REPLACE INTO pages (id, html, created_at) VALUES (?, ?, ?)",
-            (sid, compressed, datetime.utcnow()),
+            "INSERT OR REPLACE INTO pages (id, html, created_at, content_hash, last_seen, encoding, slim) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sid, compress(content, encoding=None), now, content_hash, now, encoding, slim),
         )
     
-    return html_content
+    mark_stored('pages', sid)
+    mark_stage('page', [sid])
+    return True
 
 
 def read_post_desc(sid):
     logging.debug(f'Reading description for {sid}')
-    with sqlite3.connect(DB_PAGES) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT html FROM pages WHERE id = ? LIMIT 1', (sid, ))
-        result = cursor.fetchone()
+    result = None
+    conn = connect_page_db(DB_PAGES, sid)
+    if conn:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT html, encoding FROM pages WHERE id = ? LIMIT 1', (sid, ))
+            result = cursor.fetchone()
     
     if result:
-        return decompress(result[0], encoding='detect')
+        return decompress(result[0], encoding=result[1] or 'detect')
     
     logging.warning(f'Didn\'t find stored data for {sid}')
     return
 
 
+def read_download_url(sid):
+    # only trust page_meta when it was extracted from the current page
+    conn = connect_page_db(DB_PAGES, sid)
+    if not conn:
+        return None
+    
+    with conn:
+        cursor = conn.execute(
+            'SELECT m.download_url FROM page_meta m JOIN pages p ON p.id = m.id '
+            'WHERE m.id = ? AND m.extracted_at >= p.created_at',
+            (sid, )
+        )
+        row = cursor.fetchone()
+    
+    return row[0] if row else None
+
+
+def read_post_revision(sid, rev):
+    # walk back from the current page through each newer revision's delta
+    conn = connect_page_db(DB_PAGES, sid)
+    if not conn:
+        return
+    
+    with conn:
+        cursor = conn.execute('SELECT html FROM pages WHERE id = ?', (sid, ))
+        row = cursor.fetchone()
+        if not row:
+            return
+        
+        content = decompress(row[0], encoding=None)
+        cursor = conn.execute(
+            'SELECT rev, delta FROM page_revisions WHERE id = ? AND rev >= ? ORDER BY rev DESC',
+            (sid, rev)
+        )
+        for _, delta in cursor:
+            content = delta_decompress(delta, content)
+    
+    return content
+
+
 def find_missing_posts(db_file: str, table: str, batch_size: int = 10000) -> Iterator[int]:
+    # media deferred by prescreening never gets a files row, it isn't missing
+    source = {'pages': DB_PAGES, 'files': DB_MEDIA}.get(table)
+    if 'posts' in sid_bitmaps and table in sid_bitmaps and db_file == source:
+        stored = sid_bitmaps[table]
+        deferred = set()
+        if table == 'files':
+            with sqlite3.connect(db_file) as conn:
+                deferred = {row[0] for row in conn.execute('SELECT id FROM media_deferred')}
+        
+        batch = []
+        for sid in sid_bitmaps['posts']:
+            if sid not in stored and sid not in deferred:
+                batch.append(sid)
+            
+            if len(batch) >= batch_size:
+                found = set(bitmap_exists(table, batch))
+                yield from (sid for sid in batch if sid not in found)
+                batch = []
+        
+        found = set(bitmap_exists(table, batch))
+        yield from (sid for sid in batch if sid not in found)
+        return
+    
+    if table == 'pages' and is_partitioned(db_file):
+        yield from find_missing_partitioned(db_file, batch_size)
+        return
+    
+    deferred = 'AND p.id NOT IN (SELECT id FROM otherdb.media_deferred)' if table == 'files' else ''
     offset = 0
     with sqlite3.connect(DB_FAVES) as conn:
         conn.execute(f"ATTACH DATABASE '{db_file}' AS otherdb")
@@ -254,7 +705,7 @@ def find_missing_posts(db_file: str, table: str, batch_size: int = 10000) -> Ite
                 SELECT p.id
                 FROM posts p
                 LEFT JOIN otherdb.{table} f ON p.id = f.id
-                WHERE f.id IS NULL
+                WHERE f.id IS NULL {deferred}
                 LIMIT {batch_size} OFFSET {offset}
             """)
             rows = cursor.fetchall()
@@ -267,31 +718,133 @@ def find_missing_posts(db_file: str, table: str, batch_size: int = 10000) -> Ite
             offset += batch_size
 
 
-def fetch_post_media(sid, html_content, recursion=0):
-    if not html_content:
-        html_content = read_post_desc(sid)
+def find_missing_partitioned(db_pages: str, batch_size: int = 10000) -> Iterator[int]:
+    # posts in id order, each chunk checked against the partitions its ids fall in
+    last_id = -1
+    with sqlite3.connect(DB_FAVES) as conn:
+        while True:
+            cursor = conn.execute('SELECT id FROM posts WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size))
+            ids = [row[0] for row in cursor]
+            if not ids:
+                break
+            
+            last_id = ids[-1]
+            found = set(existing_ids(db_pages, ids))
+            for sid in ids:
+                if sid not in found:
+                    yield sid
+
+
+def get_media_index():
+    with media_index_lock:
+        if not media_index:
+            with sqlite3.connect(DB_MEDIA) as conn:
+                ids, hashes = load_hash_index(conn)
+            media_index.update(ids=ids, hashes=hashes, count=len(ids))
+        
+            logging.info(f'Loaded {len(ids):,} media hashes for prescreening')
     
-    soup = BeautifulSoup(html_content, 'html.parser')
-    container = soup.find('div', class_='aligncenter auto_link hideonfull1 favorite-nav')
+        count = media_index['count']
+        return media_index['ids'][:count], media_index['hashes'][:count]
+
+
+def add_to_media_index(sid, file_hash):
+    if not media_index or file_hash is None:
+        return
     
-    if not container:
-        logging.warning(f"{sid} Download button not found")
-        if recursion == 0:
-            html_content = fetch_post_desc(sid)
-            return fetch_post_media(sid, html_content, recursion=recursion+1)
+    with media_index_lock:
+        count = media_index['count']
+        if count == len(media_index['ids']):
+            # grow by half so appends are amortised O(1), slices already handed out keep the old buffers
+            size = max(1024, count + count // 2)
+            for key in ('ids', 'hashes'):
+                grown = np.empty(size, dtype=media_index[key].dtype)
+                grown[:count] = media_index[key][:count]
+                media_index[key] = grown
         
+        media_index['ids'][count] = sid
+        media_index['hashes'][count] = to_unsigned(file_hash)
+        media_index['count'] = count + 1
+
+
+def is_deferred(sid):
+    with sqlite3.connect(DB_MEDIA) as conn:
+        cursor = conn.execute('SELECT 1 FROM media_deferred WHERE id = ?', (sid, ))
+        return cursor.fetchone() is not None
+
+
+def prescreen_thumbnail(sid):
+    with sqlite3.connect(DB_FAVES) as conn:
+        cursor = conn.execute('SELECT thumbnail_url FROM posts WHERE id = ?', (sid, ))
+        row = cursor.fetchone()
+    
+    if not row or not row[0]:
+        return
+    
+    url = 'https:' + row[0] if row[0].startswith('//') else row[0]
+    response = session_get(url, s=session)
+    if response.status_code != 200:
+        return
+    
+    thumb_hash = calculate_average_hash(io.BytesIO(response.content))
+    if not thumb_hash:
         return
     
-    # Search for the Download link within the container
-    download_link = container.find('a', string='Download')
+    thumb_hash = to_signed(int(thumb_hash, 16))
+    ids, hashes = get_media_index()
+    idx, dists = hamming_search([thumb_hash], hashes, PRESCREEN_DISTANCE)[0]
+    if not len(idx):
+        return
+    
+    match_id, distance = int(ids[idx[0]]), int(dists[0])
+    with sqlite3.connect(DB_MEDIA) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO media_deferred (id, thumb_hash, match_id, distance, created_at) VALUES (?, ?, ?, ?, ?)",
+            (sid, thumb_hash, match_id, distance, datetime.utcnow())
+        )
+    
+    return match_id, distance
+
+
+def fetch_post_media(sid, html_content, recursion=0, prescreen=None):
+    # True once the media bytes are written, whether or not they could be hashed
+    if prescreen is None:
+        prescreen = PRESCREEN_THUMBNAILS
+    
+    if prescreen and recursion == 0:
+        if is_deferred(sid):
+            logging.debug(f'{sid} deferred as a likely duplicate, skipping')
+            return False
+        
+        match = prescreen_thumbnail(sid)
+        if match:
+            logging.info(f'{sid} thumbnail matches {match[0]} (distance {match[1]}), deferring download')
+            return False
+    
+    # prefer the url page_extract already pulled out of the stored page
     full_url = None
-    if download_link and download_link.has_attr('href'):
-        href = download_link['href']
-        full_url = 'https:' + href if href.startswith('//') else href
+    if not html_content:
+        full_url = read_download_url(sid)
+        if not full_url:
+            html_content = read_post_desc(sid)
+    
+    if not full_url:
+        soup = BeautifulSoup(html_content, 'html.parser')
+        container = find_download_container(soup)
+    
+        if not container:
+            logging.warning(f"{sid} Download button not found")
+            if recursion == 0:
+                html_content = fetch_post_desc(sid)
+                return fetch_post_media(sid, html_content, recursion=recursion+1)
+        
+            return False
+    
+        full_url = download_url_from_container(container)
     
     if not full_url:
         logging.warning(f"{sid} Download link not found in container")
-        return
+        return False
     
     if recursion == 0 and len(full_url) > 100 and full_url.count('%') > 3:# arbitrary but let's see how it works
         html_content = fetch_post_desc(sid)
@@ -311,28 +864,50 @@ def fetch_post_media(sid, html_content, recursion=0):
             logging.error('Response still not 200, aborting...')
             exit()
     
+    return store_post_media(sid, full_url, file_response.iter_content(chunk_size=8192))
+
+
+def store_post_media(sid, full_url, chunks, values=None):
+    # values: fingerprints computed by the caller from the same bytes, so the decode can happen
+    # outside whatever lock the caller holds for the db writes
     ext = Path(full_url).suffix  # keep the extension (.jpg, .png, .txt, etc.)
     filepath  = get_storage_path(sid, MEDIA_DIR).with_suffix(ext)
     filepath.parent.mkdir(parents=True, exist_ok=True)  # Create dirs if needed
     
     with open(filepath, 'wb') as fh:
-        for chunk in file_response.iter_content(chunk_size=8192):
+        for chunk in chunks:
             fh.write(chunk)
     
-    file_hash = None
-    try:
-        file_hash = calculate_average_hash(filepath)
-        file_hash = to_signed(int(file_hash, 16))
-    except Exception:
-        return
+    mark_stage('media', [sid])
+    if values is None:
+        values = fingerprint_image(filepath, FINGERPRINT_COLUMNS)
+    file_hash = values.get('hash')
+    if file_hash is None:
+        return True  # not an image, stored without a files row
+    
+    columns = ['id', 'path', 'fp_state'] + list(values)
+    placeholders = ', '.join('?' * len(columns))
     
     path_str = str(filepath).lstrip(str(MEDIA_DIR))
     with sqlite3.connect(DB_MEDIA) as conn:
+        archived = conn.execute("SELECT archive_path FROM media_archive WHERE id = ?", (sid, )).fetchone()
         conn.execute(
-            "INSERT OR REPLACE INTO files (id, path, hash) VALUES (?, ?, ?)",
-            (sid, path_str, file_hash)
+            f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({placeholders})",
+            (sid, path_str, fingerprint_bits(values), *values.values())
         )
+        # the new loose copy replaces a packed or archived one
+        conn.execute("DELETE FROM media_packed WHERE id = ?", (sid, ))
+        conn.execute("DELETE FROM media_archive WHERE id = ?", (sid, ))
+        conn.execute("DELETE FROM media_pack_skipped WHERE id = ?", (sid, ))
         conn.commit()
+    
+    if archived and archived[0] and archived[0] != path_str:
+        (MEDIA_DIR / archived[0]).unlink(missing_ok=True)
+
+    add_to_media_index(sid, file_hash)
+    mark_stored('files', sid)
+    mark_stage('hashed', [sid])
+    return True
 
 
 def check_posts():
@@ -340,9 +915,12 @@ def check_posts():
     
     added = set()
     
-    for sid in find_missing_posts(DB_PAGES, 'pages', batch_size=5000):
+    # checked for media in one go, most posts missing a page are missing their media too
+    missing_pages = list(find_missing_posts(DB_PAGES, 'pages', batch_size=5000))
+    have_media = set(check_media_exists(missing_pages))
+    for sid in missing_pages:
         held_data = fetch_post_desc(sid)
-        if not check_media_exists([sid]):
+        if sid not in have_media:
             fetch_post_media(sid, held_data)
         
         added.add(sid)
@@ -367,22 +945,29 @@ def tell_added(added):
         "overwrite": True
     }
     try:
-        requests.post("http://0.0.0.0:6992/add_posts", json=data)
+        response = requests.post(NOTIFY_URL, json=data)
+        if response.ok:
+            mark_notified(added)
     
     except requests.exceptions.RequestException as e:
         logging.error(f"Request failed: {e}")
 
 
-def main():
+def main(reconcile=False, allow_mass_removal=False):
+    load_sid_bitmaps()
+    
     added = check_import_folder()
     tell_added(added)
     
-    added = crawl_favourites('codedcells')
+    if reconcile:
+        added = reconcile_favourites('codedcells', allow_mass_removal)
+    else:
+        added = crawl_favourites('codedcells')
     tell_added(added)
     
     added = check_posts()
     tell_added(added)
-    
+    flush_stages()
 
 if __name__ == '__main__':
     config_logger('faves_get')
@@ -391,4 +976,8 @@ if __name__ == '__main__':
     
     session = create_session('boidd', 'cfg/')
     
-    main()
\ No newline at end of file
+    if '--watch-imports' in sys.argv:
+        load_sid_bitmaps()
+        watch_import_folder()
+    else:
+        main(reconcile='--reconcile' in sys.argv, allow_mass_removal='--allow-mass-removal' in sys.argv)
\ No newline at end of file
@@ -0,0 +1,99 @@
+# fingerprint backfill
+# fill in missing per-algorithm hashes on files, one decode per file however many are missing
+
+# 1. walk files in id order, picking rows missing any requested algorithm
+# 2. decode and shrink each image once in a process pool, compute only the missing hashes
+# 3. write the values and mark the algorithms as tried in fp_state, so reruns resume
+
+import argparse
+import io
+from multiprocessing import Pool
+
+from fugsy_lib import *
+from faves_get import DB_MEDIA, MEDIA_DIR
+
+BATCH_SIZE = 1000
+
+
+def missing_filter(columns):
+    # a column counts as missing when it's empty and hasn't been tried before
+    return ' OR '.join(
+        f'({column} IS NULL AND (COALESCE(fp_state, 0) & {FINGERPRINTS[column][1]}) = 0)' for column in columns
+    )
+
+
+def fingerprint_row(row):
+    sid, path, start, length, missing = row
+    if start is None:
+        return sid, missing, fingerprint_image(MEDIA_DIR / path, missing)
+    
+    return sid, missing, fingerprint_image(io.BytesIO(read_media(MEDIA_DIR, path, start, length)), missing)
+
+
+def iter_missing(conn, columns, batch_size=BATCH_SIZE):
+    last_id = -1
+    selected = ', '.join(columns)
+    while True:
+        rows = conn.execute(
+            f'SELECT f.id, COALESCE(k.path, f.path), p.start, p.length, COALESCE(fp_state, 0), {selected} '
+            f'FROM files f LEFT JOIN media_packed p ON p.id = f.id LEFT JOIN media_packs k ON k.id = p.pack_id '
+            f'WHERE f.id > ? AND ({missing_filter(columns)}) ORDER BY f.id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        
+        last_id = rows[-1][0]
+        batch = []
+        for sid, path, start, length, state, *values in rows:
+            missing = [
+                column for column, value in zip(columns, values)
+                if value is None and not state & FINGERPRINTS[column][1]
+            ]
+            batch.append((sid, path, start, length, missing))
+        
+        yield batch
+
+
+def backfill(db_path, columns, workers=None, batch_size=BATCH_SIZE):
+    init_media_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    
+    done = 0
+    computed = {column: 0 for column in columns}
+    start = time.time()
+    
+    with Pool(processes=workers) as pool:
+        for batch in iter_missing(conn, columns, batch_size):
+            with conn:
+                for sid, missing, values in pool.imap_unordered(fingerprint_row, batch, chunksize=8):
+                    sets = ', '.join(f'{column} = COALESCE({column}, ?)' for column in missing)
+                    conn.execute(
+                        f'UPDATE files SET {sets}, fp_state = COALESCE(fp_state, 0) | ? WHERE id = ?',
+                        (*[values[column] for column in missing], fingerprint_bits(missing), sid)
+                    )
+                    for column in missing:
+                        computed[column] += values[column] is not None
+            
+            done += len(batch)
+            logging.info(f'Up to {batch[-1][0]}: {done:,} files, {done / (time.time() - start):,.1f} files/s, {computed}')
+    
+    conn.close()
+    logging.info(f'Fingerprinted {done:,} files in {time.time() - start:,.1f}s: {computed}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill missing image fingerprints in files.')
+    parser.add_argument('algorithms', nargs='*', default=list(FINGERPRINTS), choices=list(FINGERPRINTS))
+    parser.add_argument('--db', default=DB_MEDIA)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    
+    backfill(args.db, args.algorithms, args.workers, args.batch)
+
+
+if __name__ == '__main__':
+    config_logger('fingerprint')
+    main()
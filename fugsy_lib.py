@@ -1,20 +1,51 @@
 import sqlite3
 from pathlib import Path
-from PIL import Image
-import imagehash
-import zstandard as zstd
+import importlib.util
 import shutil
 import os
 import re
-import requests
 import string
+import sys
+import signal
+import atexit
+import threading
 
 import logging
 import time
 from datetime import datetime, timedelta
 from sys import stdout
 
-from charset_normalizer import from_path, from_bytes
+
+def lazy_import(name):
+    # module is only executed on first attribute access, keeps short runs fast to start
+    if name in sys.modules:
+        return sys.modules[name]
+    
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def preload(*modules):
+    # runs lazy modules now, LazyLoader isn't safe to trigger from several threads at once
+    # before python 3.12, so touch them before starting threads that use them
+    for module in modules:
+        module.__name__
+
+
+Image = lazy_import('PIL.Image')
+imagehash = lazy_import('imagehash')
+np = lazy_import('numpy')
+zstd = lazy_import('zstandard')
+requests = lazy_import('requests')
+charset_normalizer = lazy_import('charset_normalizer')
 
 
 def config_logger(name):
@@ -32,6 +63,138 @@ def config_logger(name):
     logging.getLogger().addHandler(logging.StreamHandler(stdout))
 
     logging.info(f'Logging Started')
+    
+    start_profiler(name, now)
+
+
+# opt-in stack sampling for long runs, FUGSY_PROFILE=run samples from the start,
+# FUGSY_PROFILE=signal waits for SIGUSR1, which toggles sampling on and off either way
+PROFILE_ENV = 'FUGSY_PROFILE'
+PROFILE_INTERVAL_ENV = 'FUGSY_PROFILE_INTERVAL'
+PROFILE_INTERVAL = 0.01  # seconds between samples
+PROFILE_FLUSH = 60  # seconds between rewrites of the output, so a killed run still leaves one
+
+profiler = [None]
+
+
+class StackSampler:
+    # a daemon thread that samples every other thread's stack and counts them,
+    # written out as folded stacks (flamegraph.pl, speedscope, inferno)
+    def __init__(self, path_base, interval=PROFILE_INTERVAL, flush_every=PROFILE_FLUSH):
+        self.path_base = path_base
+        self.interval = interval
+        self.flush_every = flush_every
+        self.counts = {}
+        self.samples = 0
+        self.session = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def path(self):
+        return f'{self.path_base}-profile{self.session}.folded'
+    
+    def start(self):
+        if self.thread:
+            return
+        
+        self.session += 1
+        self.counts = {}
+        self.samples = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+        self.thread.start()
+        logging.info(f'Profiler sampling every {self.interval * 1000:.0f}ms into {self.path()}')
+    
+    def stop(self):
+        if not self.thread:
+            return
+        
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.write()
+        logging.info(f'Profiler stopped, {self.samples:,} samples written to {self.path()}')
+    
+    def toggle(self, signum=None, frame=None):
+        if self.thread:
+            self.stop()
+        else:
+            self.start()
+    
+    def run(self):
+        own = threading.get_ident()
+        last_flush = time.time()
+        while not self.stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    
+                    stack = fold_stack(frame, names.get(ident, str(ident)))
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+                
+                self.samples += 1
+            
+            if time.time() - last_flush >= self.flush_every:
+                self.write()
+                last_flush = time.time()
+    
+    def write(self):
+        with self.lock:
+            lines = [f'{stack} {n}\n' for stack, n in self.counts.items()]
+        
+        tmp_path = self.path() + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            fh.writelines(lines)
+        
+        os.replace(tmp_path, self.path())
+
+
+def fold_stack(frame, thread_name):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    
+    frames.append(thread_name)
+    return ';'.join(reversed(frames))
+
+
+def start_profiler(name, now=None, mode=None):
+    # --profile is taken out of argv so scripts with their own argparse don't trip on it
+    if '--profile' in sys.argv:
+        sys.argv.remove('--profile')
+        mode = mode or 'run'
+    
+    mode = mode or os.environ.get(PROFILE_ENV)
+    if not mode or profiler[0]:
+        return profiler[0]
+    
+    now = now or datetime.now()
+    os.makedirs(f'log/{name}/', exist_ok=True)
+    sampler = StackSampler(
+        f"log/{name}/{now.isoformat().replace(':', '-')}",
+        float(os.environ.get(PROFILE_INTERVAL_ENV, PROFILE_INTERVAL))
+    )
+    
+    try:
+        signal.signal(signal.SIGUSR1, sampler.toggle)
+    except (AttributeError, ValueError):
+        # no SIGUSR1 on windows, and handlers can only be set from the main thread
+        logging.warning('Could not install the SIGUSR1 profiler toggle')
+    
+    atexit.register(sampler.stop)
+    if mode != 'signal':
+        sampler.start()
+    else:
+        logging.info(f'Profiler armed, send SIGUSR1 to pid {os.getpid()} to start and stop sampling')
+    
+    profiler[0] = sampler
+    return sampler
 
 
 def create_session(u, folder=''):
@@ -52,15 +215,19 @@ def create_session(u, folder=''):
 last_request_time = [0]  # Use list to allow modification in nested functions
 
 rate_delay = 2
+retry_delay = 3  # wait after a 5xx before trying again
+rate_lock = threading.Lock()
 
 def rate_limited_request():
-    now = time.time()
-    elapsed = now - last_request_time[0]
+    # each caller reserves the next slot under the lock and sleeps outside it,
+    # so threads sharing the limit still go out rate_delay apart
+    with rate_lock:
+        now = time.time()
+        slot = max(now, last_request_time[0] + rate_delay)
+        last_request_time[0] = slot
 
-    if elapsed < rate_delay:
-        time.sleep(rate_delay - elapsed)
-
-    last_request_time[0] = time.time()
+    if slot > now:
+        time.sleep(slot - now)
 
 
 def session_get(url, s=None, d=0):
@@ -71,7 +238,7 @@ def session_get(url, s=None, d=0):
     sg = s.get(url)
     if sg.status_code > 499:
         logging.info(f'Server gave {sg.status_code}, waiting ({url})')
-        time.sleep(3)
+        time.sleep(retry_delay)
         return session_get(url, s=s, d=d+1)
     
     return sg
@@ -85,12 +252,238 @@ def session_post(url, data, s=None, d=0):
     sg = s.post(url, data=data)
     if sg.status_code > 499:
         logging.info(f'Server gave {sg.status_code}, waiting ({url})')
-        time.sleep(3)
+        time.sleep(retry_delay)
         return session_post(url, data, s=s, d=d+1)
     
     return sg
 
 
+def ensure_column(conn, table: str, column: str, decl: str):
+    cur = conn.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cur.fetchall()]:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_version(conn, version):
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def add_columns(table: str, *columns):
+    # a migration step adding (column, decl) pairs, columns that are already there are left alone
+    def migration(conn):
+        for column, decl in columns:
+            ensure_column(conn, table, column, decl)
+    
+    return migration
+
+
+def run_migrations(conn, migrations):
+    # migrations: [(version, name, step), ...] in version order, step is a function(conn) or an sql script,
+    # each runs once for every version above PRAGMA user_version. dbs made before the runner are at
+    # version 0 with some of the schema already there, so steps use IF NOT EXISTS and ensure_column
+    current = get_version(conn)
+    for version, name, migration in migrations:
+        if version <= current:
+            continue
+        
+        logging.info(f"Migrating to version {version}: {name}")
+        start = time.time()
+        if callable(migration):
+            migration(conn)
+        else:
+            conn.executescript(migration)
+        with conn:
+            set_version(conn, version)
+        
+        current = version
+        logging.info(f"Version {version} done in {time.time() - start:,.1f}s")
+    
+    return current
+
+
+def add_fingerprint_columns(conn):
+    # one column per fingerprint algorithm (phash is the 256 bit re-ranking hash),
+    # fp_state has a bit set per algorithm tried. a new algorithm gets a new migration that runs this again
+    for column, (decl, _, _) in FINGERPRINTS.items():
+        ensure_column(conn, 'files', column, decl)
+    ensure_column(conn, 'files', 'fp_state', 'INTEGER')
+
+
+MEDIA_MIGRATIONS = [
+    # storer's rescans: one row per seen path, hash is cached against (size, mtime, inode)
+    (1, 'manifest', """
+        CREATE TABLE IF NOT EXISTS manifest (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            hash TEXT,
+            hashed INTEGER NOT NULL DEFAULT 0
+        );
+    """),
+    (2, 'fingerprint columns', add_fingerprint_columns),
+    # media skipped because its thumbnail matched something already stored
+    (3, 'media_deferred', """
+        CREATE TABLE IF NOT EXISTS media_deferred (
+            id INTEGER PRIMARY KEY,
+            thumb_hash INTEGER,
+            match_id INTEGER,
+            distance INTEGER,
+            created_at DATETIME
+        );
+    """),
+    # losslessly re-encoded copies made by media_archive, files.path is moved to archive_path,
+    # rows without an archive_path were checked and left as they are, note says why
+    (4, 'media_archive', """
+        CREATE TABLE IF NOT EXISTS media_archive (
+            id INTEGER PRIMARY KEY,
+            orig_path TEXT NOT NULL,
+            orig_format TEXT,
+            orig_size INTEGER,
+            orig_sha256 TEXT,
+            archive_path TEXT,
+            archive_format TEXT,
+            archive_size INTEGER,
+            pixels_sha256 TEXT,
+            archived_at DATETIME,
+            note TEXT
+        );
+    """),
+    # append-only pack segments written by media_pack, size is how much of the file is committed,
+    # anything past it is from an interrupted write and gets truncated away.
+    # media_packed has the small files moved into a pack, name is the loose path they came from
+    (5, 'media packs', """
+        CREATE TABLE IF NOT EXISTS media_packs (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME,
+            sealed_at DATETIME
+        );
+        CREATE TABLE IF NOT EXISTS media_packed (
+            id INTEGER PRIMARY KEY,
+            pack_id INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            sha256 TEXT,
+            packed_at DATETIME
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_packed_pack ON media_packed(pack_id, start);
+    """),
+    # files media_pack looked at and left loose for being too big, so later runs don't stat them again
+    (6, 'media_pack_skipped', """
+        CREATE TABLE IF NOT EXISTS media_pack_skipped (
+            id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL
+        );
+    """),
+]
+
+
+def init_media_db(db_path: str):
+    with sqlite3.connect(db_path) as conn:
+        # WAL so backup can copy it inside the same read snapshot as the other dbs while it's written
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL,
+                hash INTEGER
+            )
+        """)
+        conn.commit()
+        run_migrations(conn, MEDIA_MIGRATIONS)
+
+
+def media_location(conn, file_id):
+    # (path, name, start, length) relative to the media dir, start and length are None for a loose file,
+    # for a packed one path is the pack and name the loose path it came from
+    cur = conn.execute(
+        "SELECT f.path, k.path, p.name, p.start, p.length FROM files f "
+        "LEFT JOIN media_packed p ON p.id = f.id "
+        "LEFT JOIN media_packs k ON k.id = p.pack_id "
+        "WHERE f.id = ?",
+        (file_id, )
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    
+    path, pack_path, name, start, length = row
+    if pack_path is None:
+        return path, path, None, None
+    
+    return pack_path, name, start, length
+
+
+def read_media(base_dir, path, start=None, length=None) -> bytes:
+    with open(Path(base_dir) / path, 'rb') as fh:
+        if start is None:
+            return fh.read()
+        
+        fh.seek(start)
+        return fh.read(length)
+
+
+PAGES_MIGRATIONS = [
+    # zstd level the blob was recompressed at by pages_maint, NULL means the default
+    (1, 'pages.zlevel', add_columns('pages', ('zlevel', 'INTEGER'))),
+    # hash of the normalized page, an unchanged refetch only touches last_seen
+    (2, 'pages.content_hash', add_columns('pages', ('content_hash', 'BLOB'), ('last_seen', 'DATETIME'))),
+    # encoding detected once on the way in, so reads can decode without charset detection
+    (3, 'pages.encoding', add_columns('pages', ('encoding', 'TEXT'))),
+    # 1 when only the regions kept by fa_common.slim_page are stored, 0 when the page
+    # had to be kept whole, NULL when it was stored whole without trying
+    (4, 'pages.slim', add_columns('pages', ('slim', 'INTEGER'))),
+    # older versions of a page, each stored as a zstd delta against the version after it
+    (5, 'page_revisions', """
+        CREATE TABLE IF NOT EXISTS page_revisions (
+            id INTEGER NOT NULL,
+            rev INTEGER NOT NULL,
+            created_at DATETIME,
+            content_hash BLOB,
+            delta BLOB,
+            PRIMARY KEY (id, rev)
+        );
+    """),
+    # structured fields pulled out of the stored page by page_extract
+    (6, 'page_meta', """
+        CREATE TABLE IF NOT EXISTS page_meta (
+            id INTEGER PRIMARY KEY,
+            download_url TEXT,
+            title TEXT,
+            tags TEXT,
+            rating TEXT,
+            uploader TEXT,
+            posted_at TEXT,
+            extracted_at DATETIME
+        );
+    """),
+]
+
+
+def init_pages_db(db_path: str):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY,
+            html BLOB,
+            created_at DATETIME
+        );
+        """
+    )
+    conn.commit()
+    run_migrations(conn, PAGES_MIGRATIONS)
+    return conn
+
+
 def get_storage_path(file_id: int, base_dir: Path) -> Path:
     s = str(file_id).zfill(9)
     subdirs = [s[:2], s[2:4], s[4:6]]
@@ -107,6 +500,71 @@ def calculate_average_hash(image_path: str) -> str:
         return None
 
 
+def calculate_phash(image_path: str, hash_size: int = 16) -> bytes:
+    try:
+        img = Image.open(image_path)
+        return bytes.fromhex(str(imagehash.phash(img, hash_size=hash_size)))
+    
+    except Exception as e:
+        logging.warning(f"Could not phash image {image_path}: {e}")
+        return None
+
+
+FINGERPRINT_SIZE = 256  # images are decoded and shrunk to this once, every hash works from it
+
+
+def hash_to_int(h) -> int:
+    return to_signed(int(str(h), 16))
+
+
+def hash_to_bytes(h) -> bytes:
+    return bytes.fromhex(str(h))
+
+
+# column: (sql type, bit in fp_state, fn(prepared image) -> stored value)
+FINGERPRINTS = {
+    'hash': ('INTEGER', 1, lambda img: hash_to_int(imagehash.average_hash(img))),
+    'phash': ('BLOB', 2, lambda img: hash_to_bytes(imagehash.phash(img, hash_size=16))),
+    'dhash': ('INTEGER', 4, lambda img: hash_to_int(imagehash.dhash(img))),
+    'chash': ('TEXT', 8, lambda img: str(imagehash.colorhash(img))),
+}
+
+
+def prepare_image(image_path):
+    img = Image.open(image_path)
+    img.draft('RGB', (FINGERPRINT_SIZE, FINGERPRINT_SIZE))  # lets jpeg decode at a fraction of full size
+    img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    img.thumbnail((FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+    return img
+
+
+def fingerprint_image(image_path, columns=None):
+    # decode once, then compute every requested hash from the same small buffer
+    columns = columns or list(FINGERPRINTS)
+    values = {column: None for column in columns}
+    try:
+        img = prepare_image(image_path)
+    except Exception as e:
+        logging.warning(f"Could not decode image {image_path}: {e}")
+        return values
+    
+    for column in columns:
+        try:
+            values[column] = FINGERPRINTS[column][2](img)
+        except Exception as e:
+            logging.warning(f"Could not {column} image {image_path}: {e}")
+    
+    return values
+
+
+def fingerprint_bits(columns) -> int:
+    bits = 0
+    for column in columns:
+        bits |= FINGERPRINTS[column][1]
+    
+    return bits
+
+
 def to_signed(val: int) -> int:
     if val >= 2**63:
         val -= 2**64
@@ -118,11 +576,186 @@ def to_unsigned(val: int) -> int:
     return val
 
 
-def compress(data, encoding="utf-8"):
+def parse_hash(val) -> int:
+    # user input: an int, a decimal string or a 0x prefixed hex string, ValueError for anything else
+    if isinstance(val, bool) or not isinstance(val, (int, str)):
+        raise ValueError(f'{val!r} is not a hash')
+    
+    if isinstance(val, str):
+        text = val.strip().lower()
+        val = int(text, 16) if text.startswith('0x') else int(text)
+    
+    if not -2**63 <= val < 2**64:
+        raise ValueError(f'{val} does not fit in 64 bits')
+    
+    return to_signed(val)
+
+
+def parse_stored_hash(val) -> int:
+    # files.hash is an int, or the 16 char hex string storer wrote from imagehash
+    if isinstance(val, str) and len(val.strip()) == 16:
+        return to_signed(int(val, 16))
+    
+    return parse_hash(val)
+
+
+def load_hash_index(conn):
+    cur = conn.execute("SELECT id, hash FROM files WHERE hash IS NOT NULL")
+    rows = cur.fetchall()
+    
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    hashes = np.fromiter((parse_stored_hash(row[1]) for row in rows), dtype=np.int64, count=len(rows))
+    return ids, hashes.view(np.uint64)
+
+
+_popcount_table = []
+
+def popcount_table():
+    if not _popcount_table:
+        _popcount_table.append(np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8))
+    
+    return _popcount_table[0]
+
+
+def popcount64(arr):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(arr)
+    
+    return popcount_table()[arr.view(np.uint8)].reshape(arr.shape + (8, )).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_search(targets, hashes, max_distance: int, chunk_cells: int = 2**24):
+    # one xor/popcount pass per chunk of targets, returns (index, distance) arrays per target
+    targets = np.asarray([to_unsigned(parse_stored_hash(t)) for t in targets], dtype=np.uint64)
+    results = []
+    if not len(hashes):
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)) for _ in targets]
+    
+    step = max(1, chunk_cells // len(hashes))
+    for i in range(0, len(targets), step):
+        dist = popcount64(targets[i:i + step, None] ^ hashes[None, :])
+        for row in dist:
+            idx = np.nonzero(row <= max_distance)[0]
+            order = np.argsort(row[idx], kind='stable')
+            results.append((idx[order], row[idx][order]))
+    
+    return results
+
+
+def blob_distances(target: bytes, blobs):
+    # hamming distance from target to each same sized blob, None where missing
+    size = len(target)
+    present = [i for i, b in enumerate(blobs) if b is not None and len(b) == size]
+    dists = [None] * len(blobs)
+    if not present:
+        return dists
+    
+    arr = np.frombuffer(b''.join(blobs[i] for i in present), dtype=np.uint8).reshape(len(present), size)
+    counts = popcount_table()[arr ^ np.frombuffer(target, dtype=np.uint8)].sum(axis=1)
+    for i, d in zip(present, counts.tolist()):
+        dists[i] = d
+    
+    return dists
+
+
+class SidBitmap:
+    # one bit per sid, sids are dense ints so 100M of them fit in about 12 MB,
+    # membership is a byte lookup instead of a db round trip
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+        self.lock = threading.Lock()
+    
+    def __contains__(self, sid):
+        i = sid >> 3
+        return 0 <= i < len(self.bits) and bool(self.bits[i] & (1 << (sid & 7)))
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        # ascending, unpacked a chunk at a time
+        step = 1 << 20
+        for start in range(0, len(self.bits), step):
+            chunk = np.frombuffer(bytes(self.bits[start:start + step]), dtype=np.uint8)
+            for offset in np.flatnonzero(np.unpackbits(chunk, bitorder='little')):
+                yield start * 8 + int(offset)
+    
+    def grow(self, sid):
+        need = (sid >> 3) + 1
+        if need > len(self.bits):
+            self.bits.extend(bytes(max(need - len(self.bits), len(self.bits) // 4)))
+    
+    def add(self, sid):
+        with self.lock:
+            self.grow(sid)
+            mask = 1 << (sid & 7)
+            if not self.bits[sid >> 3] & mask:
+                self.bits[sid >> 3] |= mask
+                self.count += 1
+    
+    def add_many(self, sids):
+        ids = np.asarray(sids, dtype=np.int64)
+        if not len(ids):
+            return
+        
+        with self.lock:
+            self.grow(int(ids.max()))
+            self.count += self.set_bits(ids)
+    
+    def set_bits(self, ids):
+        # the array borrows the bytearray's buffer, which can't grow until it's released
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        touched = np.unique(ids >> 3)
+        before = int(popcount_table()[bits[touched]].sum())
+        np.bitwise_or.at(bits, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+        added = int(popcount_table()[bits[touched]].sum()) - before
+        del bits
+        return added
+
+
+def load_sid_bitmap(db_paths, table: str, batch_size: int = 1_000_000) -> SidBitmap:
+    bitmap = SidBitmap()
+    for path in db_paths:
+        with sqlite3.connect(path) as conn:
+            cursor = conn.execute(f'SELECT id FROM {table}')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                
+                bitmap.add_many([row[0] for row in rows])
+    
+    return bitmap
+
+
+def compress(data, encoding="utf-8", level=3):
     if encoding:
         data = data.encode("utf-8")
     
-    return zstd.ZstdCompressor().compress(data)
+    return zstd.ZstdCompressor(level=level).compress(data)
+
+
+def delta_compress(data: bytes, base: bytes, level=19) -> bytes:
+    # base is used as a raw content dictionary, so shared runs cost almost nothing
+    dict_data = zstd.ZstdCompressionDict(base, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+    return zstd.ZstdCompressor(level=level, dict_data=dict_data).compress(data)
+
+
+def delta_decompress(delta: bytes, base: bytes) -> bytes:
+    dict_data = zstd.ZstdCompressionDict(base, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+    return zstd.ZstdDecompressor(dict_data=dict_data).decompress(delta)
+
+
+def detect_encoding(data: bytes) -> str:
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    
+    result = charset_normalizer.from_bytes(data).best()
+    return result.encoding if result else None
 
 
 def decompress(data, encoding="utf-8"):
@@ -132,7 +765,7 @@ def decompress(data, encoding="utf-8"):
         try:
             data = data.decode('utf-8')
         except UnicodeDecodeError:
-            result = from_bytes(data).best()
+            result = charset_normalizer.from_bytes(data).best()
             data = result.output()
     
     elif encoding:
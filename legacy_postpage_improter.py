@@ -7,21 +7,12 @@
 # 4. afterwards display any errored files
 
 from fugsy_lib import *
+from fa_common import page_hash, slim_page
 DB_FILE = "db/pages.db"
+SLIM_PAGES = False  # see faves_get.SLIM_PAGES
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pages (
-            id INTEGER PRIMARY KEY,
-            html BLOB,
-            created_at DATETIME
-        );
-        """
-    )
-    conn.commit()
-    return conn
+    return init_pages_db(DB_FILE)
 
 
 def compress_and_store(conn, file, name):
@@ -29,13 +20,19 @@ def compress_and_store(conn, file, name):
     with open(str(file), 'rb') as fh:
         html_data = fh.read()
     
+    slim = None
+    if SLIM_PAGES:
+        slimmed = slim_page(html_data)
+        slim = int(slimmed is not html_data)
+        html_data = slimmed
+    
     compressed = compress(html_data, encoding=None)
     file_mtime = datetime.utcfromtimestamp(file.stat().st_mtime)
     
     file_id = int(name)
     conn.execute(
-        "INSERT OR REPLACE INTO pages (id, html, created_at) VALUES (?, ?, ?)",
-        (file_id, compressed, file_mtime),
+        "INSERT OR REPLACE INTO pages (id, html, created_at, content_hash, encoding, slim) VALUES (?, ?, ?, ?, ?, ?)",
+        (file_id, compressed, file_mtime, page_hash(html_data), detect_encoding(html_data), slim),
     )
 
 def import_pages():
@@ -0,0 +1,300 @@
+# media archive tier
+# losslessly re-encode badly compressed stored media into something smaller
+
+# archive:
+#  1. pick files stored as png/bmp/tiff that aren't archived yet
+#  2. encode lossless webp and an optimized png in a process pool, keep the smallest
+#     if it saves enough, after checking the decoded pixels are identical
+#  3. with --replace, record the original's format, size and sha256 in media_archive, point files.path
+#     at the archive copy and remove the original, files that were skipped get a row with a note so
+#     later runs leave them alone
+#     without --replace nothing is written, the run only reports what replacing would save
+# verify: decode every archived copy and check it against the recorded pixel digest
+
+# the pixels and icc profile are kept exactly, the original bytes and other metadata aren't,
+# orig_sha256 can only check a re-fetched original, so replacing is opt in
+
+import argparse
+import hashlib
+import io
+from multiprocessing import Pool
+
+from fugsy_lib import *
+from faves_get import DB_MEDIA, MEDIA_DIR
+
+ARCHIVE_SUFFIXES = ('.png', '.bmp', '.tif', '.tiff')
+MIN_SAVING = 0.10  # fraction of the original size an archive copy has to save
+WEBP_METHOD = 4  # lossless effort 0-6, 6 is several times slower for a fraction of a percent
+BATCH_SIZE = 200
+
+
+def canonical_mode(image):
+    # what has to survive re-encoding, palette and grey images compare as their rgb(a) expansion
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    return 'RGBA' if has_alpha else 'RGB'
+
+
+def pixels_digest(image, mode=None):
+    # mode is the original's, webp decodes a fully opaque image without its alpha channel
+    mode = mode or canonical_mode(image)
+    pixels = image.convert(mode)
+    digest = hashlib.sha256(f'{mode} {pixels.size}'.encode())
+    digest.update(pixels.tobytes())
+    return digest.hexdigest()
+
+
+def encode_candidates(image, webp_method=WEBP_METHOD):
+    candidates = []
+    icc_profile = image.info.get('icc_profile')
+    
+    buf = io.BytesIO()
+    image.convert(canonical_mode(image)).save(
+        buf, format='WEBP', lossless=True, quality=100, method=webp_method, exact=True, icc_profile=icc_profile
+    )
+    candidates.append(('.webp', 'WEBP', buf.getvalue()))
+    
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', optimize=True, icc_profile=icc_profile)
+    candidates.append(('.png', 'PNG', buf.getvalue()))
+    
+    return sorted(candidates, key=lambda x: len(x[2]))
+
+
+def archive_file(row):
+    # write is False for a dry run, the encoded copy is measured and checked but not saved
+    sid, path, write, webp_method = row
+    src = MEDIA_DIR / path
+    try:
+        data = src.read_bytes()
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, 'n_frames', 1) > 1:
+            return sid, None, 'animated'
+        
+        if image.mode not in ('1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA'):
+            return sid, None, f'mode {image.mode}'
+        
+        image.load()
+        orig_format = image.format
+        mode = canonical_mode(image)
+        expected = pixels_digest(image, mode)
+        
+        for suffix, archive_format, encoded in encode_candidates(image, webp_method):
+            if len(encoded) > len(data) * (1 - MIN_SAVING):
+                break
+            
+            if pixels_digest(Image.open(io.BytesIO(encoded)), mode) != expected:
+                logging.warning(f'{sid}: {archive_format} copy is not pixel identical, trying the next')
+                continue
+            
+            archive_path = Path(path).with_suffix(suffix)
+            if archive_path == Path(path):
+                # never overwrite the original before its archive row is committed
+                archive_path = archive_path.with_name(f'{archive_path.stem}.opt{suffix}')
+            
+            archive_path = str(archive_path)
+            if write:
+                dest = MEDIA_DIR / archive_path
+                tmp = dest.with_name(dest.name + '.part')
+                tmp.write_bytes(encoded)
+                os.replace(tmp, dest)
+            
+            return sid, {
+                'orig_path': path,
+                'orig_format': orig_format,
+                'orig_size': len(data),
+                'orig_sha256': hashlib.sha256(data).hexdigest(),
+                'archive_path': archive_path,
+                'archive_format': archive_format,
+                'archive_size': len(encoded),
+                'pixels_sha256': expected,
+            }, None
+        
+        return sid, None, 'not smaller'
+    except Image.UnidentifiedImageError:
+        return sid, None, 'not an image'
+    except Exception as e:
+        return sid, None, str(e)
+
+
+def iter_candidates(conn, batch_size=BATCH_SIZE, retry=False):
+    suffixes = ' OR '.join(f"LOWER(f.path) LIKE '%{suffix}'" for suffix in ARCHIVE_SUFFIXES)
+    pending = '(a.id IS NULL OR a.archive_path IS NULL)' if retry else 'a.id IS NULL'
+    last_id = -1
+    while True:
+        # packed files are small and already out of the way, they're left alone
+        rows = conn.execute(
+            f'SELECT f.id, f.path FROM files f LEFT JOIN media_archive a ON a.id = f.id '
+            f'LEFT JOIN media_packed p ON p.id = f.id '
+            f'WHERE f.id > ? AND {pending} AND p.id IS NULL AND ({suffixes}) ORDER BY f.id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        
+        last_id = rows[-1][0]
+        yield rows
+
+
+def repoint_archived(conn):
+    # files.path has to name the file that exists, earlier runs left it on the removed original
+    with conn:
+        cur = conn.execute(
+            'UPDATE files SET path = (SELECT archive_path FROM media_archive a WHERE a.id = files.id) '
+            'WHERE id IN (SELECT id FROM media_archive WHERE archive_path IS NOT NULL AND archive_path != orig_path) '
+            'AND path = (SELECT orig_path FROM media_archive a WHERE a.id = files.id)'
+        )
+    
+    if cur.rowcount:
+        logging.info(f'Pointed {cur.rowcount:,} files at their archive copy')
+
+
+def archive_media(db_path, workers=None, batch_size=BATCH_SIZE, limit=None, retry=False, replace=False,
+                  webp_method=WEBP_METHOD):
+    init_media_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    repoint_archived(conn)
+    if not replace:
+        logging.info('Dry run, pass --replace to write archive copies and remove the originals')
+    
+    scanned = archived = 0
+    bytes_scanned = bytes_before = bytes_after = 0
+    skipped = {}
+    start = time.time()
+    
+    with Pool(processes=workers) as pool:
+        for rows in iter_candidates(conn, batch_size, retry):
+            paths = dict(rows)
+            done = []
+            notes = []
+            jobs = [(sid, path, replace, webp_method) for sid, path in rows]
+            for sid, info, reason in pool.imap_unordered(archive_file, jobs, chunksize=4):
+                scanned += 1
+                bytes_scanned += info['orig_size'] if info else file_size(paths[sid])
+                if info:
+                    done.append((sid, info))
+                else:
+                    notes.append((sid, paths[sid], datetime.utcnow(), reason))
+                    skipped[reason] = skipped.get(reason, 0) + 1
+            
+            if replace:
+                now = datetime.utcnow()
+                with conn:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO media_archive (id, orig_path, orig_format, orig_size, orig_sha256, '
+                        'archive_path, archive_format, archive_size, pixels_sha256, archived_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(sid, *info.values(), now) for sid, info in done]
+                    )
+                    conn.executemany(
+                        'UPDATE files SET path = ? WHERE id = ?', [(info['archive_path'], sid) for sid, info in done]
+                    )
+                    # remembered so later runs don't re-encode them, --retry tries them again
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO media_archive (id, orig_path, archived_at, note) VALUES (?, ?, ?, ?)',
+                        notes
+                    )
+            
+                # only drop originals once the archive rows are committed
+                for sid, info in done:
+                    if info['archive_path'] != info['orig_path']:
+                        (MEDIA_DIR / info['orig_path']).unlink(missing_ok=True)
+            
+            for sid, info in done:
+                archived += 1
+                bytes_before += info['orig_size']
+                bytes_after += info['archive_size']
+            
+            elapsed = time.time() - start
+            logging.info(
+                f'Up to {rows[-1][0]}: {scanned:,} scanned, {archived:,} archived, '
+                f'{(bytes_before - bytes_after) / 2**20:,.1f} MiB saved, '
+                f'{scanned / elapsed:,.1f} files/s, {bytes_scanned / 2**20 / elapsed:,.1f} MiB/s'
+            )
+            
+            if limit is not None and scanned >= limit:
+                break
+    
+    conn.close()
+    saved = bytes_before - bytes_after
+    elapsed = max(time.time() - start, 1e-9)
+    logging.info(
+        f'{"Archived" if replace else "Would archive"} {archived:,} of {scanned:,} files in {elapsed:,.1f}s '
+        f'({scanned / elapsed:,.1f} files/s, {bytes_scanned / 2**20 / elapsed:,.1f} MiB/s, webp method {webp_method}), '
+        f'{saved / 2**20:,.1f} MiB saved ({saved / max(bytes_before, 1):.1%}), skipped {skipped}'
+    )
+    return saved
+
+
+def file_size(path):
+    try:
+        return (MEDIA_DIR / path).stat().st_size
+    except OSError:
+        return 0
+
+
+def verify_file(row):
+    # the archive copy may have been packed since, start and length say where in the pack
+    sid, path, start, length, pixels_sha256 = row
+    try:
+        with Image.open(io.BytesIO(read_media(MEDIA_DIR, path, start, length))) as image:
+            # the digest covers the mode, an opaque original may have been rgba or rgb
+            return sid, any(pixels_digest(image, mode) == pixels_sha256 for mode in ('RGB', 'RGBA'))
+    except Exception as e:
+        logging.error(f'{sid}: {e}')
+        return sid, False
+
+
+def verify_archive(db_path, workers=None):
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute(
+            'SELECT a.id, COALESCE(k.path, a.archive_path), p.start, p.length, a.pixels_sha256 FROM media_archive a '
+            'LEFT JOIN media_packed p ON p.id = a.id LEFT JOIN media_packs k ON k.id = p.pack_id '
+            'WHERE a.archive_path IS NOT NULL ORDER BY a.id'
+        ).fetchall()
+    
+    bad = []
+    with Pool(processes=workers) as pool:
+        for sid, ok in pool.imap_unordered(verify_file, rows, chunksize=16):
+            if not ok:
+                bad.append(sid)
+    
+    if bad:
+        logging.error(f'{len(bad):,} of {len(rows):,} archived files failed verification: {sorted(bad)[:50]}')
+    else:
+        logging.info(f'All {len(rows):,} archived files verified')
+    
+    return not bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lossless archival re-encoding of stored media.')
+    parser.add_argument('--db', default=DB_MEDIA)
+    parser.add_argument('--workers', type=int, default=None)
+    subparsers = parser.add_subparsers(dest='command')
+    
+    archive_parser = subparsers.add_parser('archive')
+    archive_parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    archive_parser.add_argument('--limit', type=int, help='Stop after about this many files')
+    archive_parser.add_argument('--retry', action='store_true', help='Try files skipped by earlier runs again')
+    archive_parser.add_argument('--replace', action='store_true', help='Write archive copies and remove the originals')
+    archive_parser.add_argument(
+        '--webp-method', type=int, choices=range(7), default=WEBP_METHOD, help='Lossless webp effort, 6 is smallest and slowest'
+    )
+    
+    subparsers.add_parser('verify')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'archive':
+        archive_media(args.db, args.workers, args.batch, args.limit, args.retry, args.replace, args.webp_method)
+    elif args.command == 'verify':
+        if not verify_archive(args.db, args.workers):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    config_logger('media_archive')
+    main()
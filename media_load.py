@@ -0,0 +1,113 @@
+# load generator for media_man
+# hammers /get, /search and /query from a pool of threads and reports latency
+
+# 1. ask /query for some ids to use with /get
+# 2. run each endpoint for the set duration at the set concurrency
+# 3. print p50/p99 latency and requests per second per endpoint
+
+import argparse
+import random
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fugsy_lib import *
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def make_request(sess, base_url, endpoint, ids, image, query):
+    if endpoint == 'get':
+        return sess.get(f'{base_url}/get/{random.choice(ids)}')
+    
+    if endpoint == 'search':
+        return sess.post(f'{base_url}/search', files={'file': ('load.png', image)}, data={'max_distance': 5})
+    
+    return sess.get(f'{base_url}/query', params={'filename': query})
+
+
+def run_worker(base_url, endpoint, deadline, ids, image, query):
+    sess = requests.session()
+    latencies = []
+    errors = 0
+    
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            r = make_request(sess, base_url, endpoint, ids, image, query)
+            r.content  # drain the body so the timing includes it
+            if r.status_code != 200:
+                errors += 1
+        except requests.exceptions.RequestException:
+            errors += 1
+        
+        latencies.append(time.perf_counter() - start)
+    
+    return latencies, errors
+
+
+def run_endpoint(base_url, endpoint, duration, concurrency, ids, image, query):
+    deadline = time.time() + duration
+    start = time.time()
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_worker, base_url, endpoint, deadline, ids, image, query) for _ in range(concurrency)]
+        results = [f.result() for f in futures]
+    
+    elapsed = time.time() - start
+    latencies = [x for lat, _ in results for x in lat]
+    errors = sum(err for _, err in results)
+    
+    return {
+        'endpoint': endpoint,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'mean': (statistics.fmean(latencies) if latencies else 0) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running media_man.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--endpoints', nargs='+', default=['get', 'search', 'query'], choices=['get', 'search', 'query'])
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--image', help='Image to upload for /search')
+    parser.add_argument('--query', default='.png', help='Filename fragment for /query, also used to pick ids for /get')
+    args = parser.parse_args()
+    
+    rows = requests.get(f'{args.url}/query', params={'filename': args.query}).json()
+    ids = [row['id'] for row in rows]
+    
+    image = None
+    if args.image:
+        with open(args.image, 'rb') as fh:
+            image = fh.read()
+    
+    print(f"{'endpoint':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for endpoint in args.endpoints:
+        if endpoint == 'get' and not ids:
+            print(f'get: no ids matched --query {args.query!r}, skipping')
+            continue
+        
+        if endpoint == 'search' and image is None:
+            print('search: no --image given, skipping')
+            continue
+        
+        r = run_endpoint(args.url, endpoint, args.duration, args.concurrency, ids, image, args.query)
+        print(f"{r['endpoint']:<10}{r['requests']:>10,}{r['errors']:>8,}{r['rps']:>10,.1f}{r['p50']:>10.1f}{r['p99']:>10.1f}{r['mean']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,188 @@
+import argparse
+import mimetypes
+import queue
+import threading
+from contextlib import contextmanager
 from shutil import copyfile
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, send_file, render_template_string
 from fugsy_lib import *
 
 # --- Config ---
 BASE_DIR = Path("/agic/media_idx")
 DB_PATH = "/agic/media_idx/file_index.db"
+FINE_DISTANCE = 40  # max phash distance out of 256 when re-ranking
+POOL_SIZE = 8
+INDEX_REFRESH = 30  # seconds between checks for changes to files
+PACK_CHUNK = 64 * 1024  # read size when a packed file can't be sent with sendfile
 
 app = Flask(__name__)
 
 # --- Database Setup ---
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS files (
-                id INTEGER PRIMARY KEY,
-                path TEXT NOT NULL,
-                hash INTEGER
-            )
-        """)
-        conn.commit()
-
-def retrieve_file(file_id: int) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT path FROM files WHERE id = ?", (file_id,))
-        row = cur.fetchone()
-        if row:
-            return row[0]
+    init_media_db(DB_PATH)
+
+# read only connections shared by request threads, one pool per worker process
+db_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+def open_readonly():
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+@contextmanager
+def pooled_conn():
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = open_readonly()
+    
+    try:
+        yield conn
+    finally:
+        try:
+            db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+# the hash index is loaded once per worker and reloaded when the db has changed
+hash_index = {"ids": None, "hashes": None, "data_version": None, "checked": 0, "conn": None}
+hash_index_lock = threading.Lock()
+
+def get_hash_index():
+    with hash_index_lock:
+        now = time.time()
+        if hash_index["ids"] is not None and now - hash_index["checked"] < INDEX_REFRESH:
+            return hash_index["ids"], hash_index["hashes"]
+        
+        hash_index["checked"] = now
+        if hash_index["conn"] is None:
+            hash_index["conn"] = open_readonly()
+        
+        conn = hash_index["conn"]
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if hash_index["ids"] is None or data_version != hash_index["data_version"]:
+            start = time.time()
+            hash_index["ids"], hash_index["hashes"] = load_hash_index(conn)
+            hash_index["data_version"] = data_version
+            logging.info(f"Loaded {len(hash_index['ids']):,} hashes in {time.time() - start:.2f}s")
+        
+        return hash_index["ids"], hash_index["hashes"]
+
+def retrieve_file(file_id: int):
+    with pooled_conn() as conn:
+        location = media_location(conn, file_id)  # archived files are served from their archive copy
+        if location:
+            return location
         else:
             raise FileNotFoundError(f"File ID {file_id} not found in index.")
 
-def hamming_distance(h1: int, h2: int) -> int:
-    if h1 == None or h2 == None:
-        return 696969420 # can't compare nones
-    """Compute Hamming distance, first turn the back into unsigned and hash them."""
-    return int(imagehash.hex_to_hash(f"{to_unsigned(h1):016x}") - imagehash.hex_to_hash(f"{to_unsigned(h2):016x}"))
+def send_packed(pack_path, name, start, length):
+    # a range of a pack file, gunicorn's file_wrapper sendfiles exactly Content-Length bytes from the
+    # current offset without copying through python, other servers may send to the end of the
+    # file so they get it read in chunks
+    fh = open(BASE_DIR / pack_path, "rb")
+    fh.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper and request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        body = file_wrapper(fh, PACK_CHUNK)
+    else:
+        def body_chunks():
+            try:
+                left = length
+                while left > 0:
+                    chunk = fh.read(min(PACK_CHUNK, left))
+                    if not chunk:
+                        break
+                    left -= len(chunk)
+                    yield chunk
+            finally:
+                fh.close()
+        body = body_chunks()
+    
+    filename = Path(name).name
+    headers = {
+        "Content-Length": str(length),
+        "Content-Disposition": f"attachment; filename={filename}",
+    }
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return Response(body, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+def lookup_files(file_ids):
+    if not file_ids:
+        return {}
 
-def find_similar_images(image_path: str, max_distance: int = 5):
-    target_hash = calculate_average_hash(image_path)
-    if not target_hash:
-        raise ValueError("Provided file is not a valid image for hashing.")
+    placeholders = ",".join("?" * len(file_ids))
+    with pooled_conn() as conn:
+        cur = conn.execute(f"SELECT id, path, hash, phash FROM files WHERE id IN ({placeholders})", file_ids)
+        return {row[0]: row for row in cur.fetchall()}
+
+def find_similar_hashes(target_hashes, max_distance: int = 5, exclude=(), target_phashes=None, fine_distance: int = FINE_DISTANCE):
+    # stage one: 64 bit hash over the whole index, stage two: re-rank the candidates by phash
+    ids, hashes = get_hash_index()
+    found = hamming_search(target_hashes, hashes, max_distance)
+    
+    # resolve paths for every match in the batch together
+    matched = sorted(set(int(i) for idx, _ in found for i in ids[idx]))
+    rows = {}
+    for i in range(0, len(matched), 900):
+        rows.update(lookup_files(matched[i:i + 900]))
     
-    target_hash = to_signed(int(target_hash, 16))
+    if target_phashes is None:
+        target_phashes = [None] * len(found)
     
     results = []
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.create_function("HAMMING", 2, hamming_distance)
-        cursor = conn.cursor()
+    for (idx, dists), target_phash in zip(found, target_phashes):
+        matches = []
+        for file_id, dist in zip(ids[idx].tolist(), dists.tolist()):
+            if file_id in exclude or file_id not in rows:
+                continue
+            
+            _, path, stored_hash, stored_phash = rows[file_id]
+            matches.append([file_id, path, stored_hash, dist, stored_phash])
         
-        cursor.execute(
-            "SELECT id, path, hash "
-            "FROM files "
-            "WHERE hash = ?",
-            (target_hash, )
-        )
-        same_files = cursor.fetchall()
-        if same_files: # we got lucky!
-            results = [(file_id, path, stored_hash, 0) for file_id, path, stored_hash in same_files]
+        if target_phash:
+            fine = blob_distances(target_phash, [m[4] for m in matches])
+            for m, d in zip(matches, fine):
+                m[4] = d
+            
+            # candidates without a phash can't be re-ranked, keep them after the ranked ones
+            matches = [m for m in matches if m[4] is None or m[4] <= fine_distance]
+            matches.sort(key=lambda m: (m[4] is None, m[4] or 0, m[3]))
         
         else:
-            # Subquery ensures dist alias is available for filtering
-            cursor.execute(
-                "SELECT id, path, hash, HAMMING(?, hash) as dist "
-                "FROM files "
-                "WHERE dist <= ?",
-                (target_hash, max_distance)
-            )
-            
-            similar_files = cursor.fetchall()
-            print(len(similar_files))
-            for file_id, path, stored_hash, dist in similar_files:
-                results.append((file_id, path, stored_hash, dist))
+            for m in matches:
+                m[4] = None
+        
+        results.append([tuple(m) for m in matches])
+    
+    return results
+
+def parse_distances(values):
+    # max_distance and fine_distance from a form, query string or json body
+    try:
+        return int(values.get("max_distance", 5)), int(values.get("fine_distance", FINE_DISTANCE))
+    except (TypeError, ValueError):
+        raise ValueError("max_distance and fine_distance must be integers")
+
+def hash_query(image, name):
+    # the same decode and shrink stored fingerprints go through, so query and stored distances agree
+    values = fingerprint_image(image, ["hash", "phash"])
+    if values["hash"] is None:
+        raise ValueError(f"{name} is not a valid image for hashing.")
     
-    return sorted(results, key=lambda x: x[3])
+    return values["hash"], values["phash"]
+
+def hash_upload(file):
+    return hash_query(file.stream, file.filename)
+
+def find_similar_images(image_path, max_distance: int = 5):
+    target_hash, target_phash = hash_query(image_path, image_path)
+    return find_similar_hashes([target_hash], max_distance, target_phashes=[target_phash])[0]
+    
+def matches_json(matches):
+    return [
+        {"id": mid, "path": path, "hash": hash, "distance": dist, "fine_distance": fine} for mid, path, hash, dist, fine in matches
+    ]
 
 # --- Flask Routes ---
 @app.route("/")
@@ -100,6 +211,14 @@ def index():
         <button type="submit">Search</button>
     </form>
 
+    <h2>Batch Search</h2>
+    <form action="/search_batch" method="post" enctype="multipart/form-data" target="_blank">
+        <input type="file" name="file" multiple>
+        <input type="text" name="hashes" placeholder="Hashes, int or 0x hex">
+        <input type="number" name="max_distance" value="5">
+        <button type="submit">Search</button>
+    </form>
+    
     <h2>Query by Filename</h2>
     <form action="/query" method="get" target="_blank">
         <input type="text" name="filename" placeholder="Enter part of filename" required>
@@ -112,8 +231,11 @@ def index():
 @app.route("/get/<int:file_id>", methods=["GET"])
 def get_file(file_id):
     try:
-        path = retrieve_file(file_id)
-        return send_file(path, as_attachment=True)
+        path, name, start, length = retrieve_file(file_id)
+        if start is not None:
+            return send_packed(path, name, start, length)
+        
+        return send_file(BASE_DIR / path, as_attachment=True)  # stored paths are relative to BASE_DIR
     except FileNotFoundError as e:
         return jsonify({"error": str(e)}), 404
 
@@ -123,28 +245,73 @@ def search_similar():
         return jsonify({"error": "file is required"}), 400
 
     file = request.files["file"]
-    temp_path = f"/tmp/{file.filename}"
-    file.save(temp_path)
-
-    max_distance = int(request.form.get("max_distance", 5))
     try:
-        matches = find_similar_images(temp_path, max_distance)
+        max_distance, fine_distance = parse_distances(request.form)
+        target_hash, target_phash = hash_upload(file)
+        matches = find_similar_hashes([target_hash], max_distance, target_phashes=[target_phash], fine_distance=fine_distance)[0]
     except Exception as e:
-        os.remove(temp_path)
         return jsonify({"error": str(e)}), 400
 
-    os.remove(temp_path)
+    return jsonify(matches_json(matches))
+
+@app.route("/search_batch", methods=["POST"])
+def search_batch():
+    # many uploads and/or raw hashes (ints or 0x prefixed hex), answered in one pass
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify({"error": "json body must be an object"}), 400
+    
+    try:
+        max_distance, fine_distance = parse_distances({**request.form.to_dict(), **body})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    raw_hashes = body.get("hashes") or request.form.get("hashes", "").replace(",", " ").split()
+    if not isinstance(raw_hashes, list):
+        return jsonify({"error": "hashes must be a list"}), 400
+    
+    queries = []
+    try:
+        for file in request.files.getlist("file"):
+            queries.append((file.filename, *hash_upload(file)))
+        
+        for val in raw_hashes:
+            queries.append((str(val), parse_hash(val), None))
+    except (ValueError, OverflowError) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if not queries:
+        return jsonify({"error": "file or hashes is required"}), 400
+    
+    found = find_similar_hashes([q[1] for q in queries], max_distance, target_phashes=[q[2] for q in queries], fine_distance=fine_distance)
     return jsonify([
-        {"id": mid, "path": path, "hash": hash, "distance": dist} for mid, path, hash, dist in matches
+        {"query": name, "hash": h, "matches": matches_json(matches)} for (name, h, _), matches in zip(queries, found)
     ])
 
+@app.route("/similar/<int:file_id>", methods=["GET"])
+def similar_to_file(file_id):
+    try:
+        max_distance, fine_distance = parse_distances(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    row = lookup_files([file_id]).get(file_id)
+    if not row:
+        return jsonify({"error": f"File ID {file_id} not found in index."}), 404
+    
+    if row[2] is None:
+        return jsonify({"error": f"File ID {file_id} has no stored hash."}), 400
+    
+    matches = find_similar_hashes([row[2]], max_distance, exclude={file_id}, target_phashes=[row[3]], fine_distance=fine_distance)[0]
+    return jsonify(matches_json(matches))
+
 @app.route("/query", methods=["GET"])
 def query_by_filename():
     filename = request.args.get("filename")
     if not filename:
         return jsonify({"error": "filename parameter is required"}), 400
 
-    with sqlite3.connect(DB_PATH) as conn:
+    with pooled_conn() as conn:
         cur = conn.execute("SELECT id, path, hash FROM files WHERE path LIKE ?", (f"%{filename}%",))
         rows = cur.fetchall()
 
@@ -152,6 +319,35 @@ def query_by_filename():
         {"id": row[0], "path": row[1], "hash": row[2]} for row in rows
     ])
 
+def serve(host: str, port: int, workers: int, threads: int):
+    from gunicorn.app.base import BaseApplication
+    
+    class MediaManApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", False)  # each worker builds its own pool and index
+        
+        def load(self):
+            return app
+    
+    logging.info(f"Serving on {host}:{port} with {workers} workers x {threads} threads")
+    MediaManApplication().run()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the media index.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--threads", type=int, default=POOL_SIZE)
+    parser.add_argument("--debug", action="store_true", help="Single process flask dev server with reloader")
+    args = parser.parse_args()
+    
     init_db()
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        config_logger("media_man")
+        serve(args.host, args.port, args.workers, args.threads)
@@ -0,0 +1,271 @@
+# media packs
+# move small stored media out of their one-file-per-post directories into append-only pack files
+
+# pack:
+#  1. walk files in id order, skipping anything already packed or bigger than --max-size,
+#     files found too big are remembered in media_pack_skipped with their size
+#  2. append each file to the newest unsealed pack, a full pack is sealed and a new one started
+#  3. fsync the pack, then commit its offset/length rows in media_packed and the pack's new size,
+#     only then remove the loose files
+# seal: seal the active pack now instead of waiting for it to fill
+# verify: re-read every packed file and check it against its recorded sha256
+# status: list packs with their size, file count and state
+
+# a sealed pack is never written again and is made read only, so file level backups copy it once
+# files.path is left alone, lookups go through fugsy_lib.media_location which knows about packs
+# new media still land as loose files, the next pack run picks them up
+
+import argparse
+import hashlib
+
+from fugsy_lib import *
+from faves_get import DB_MEDIA, MEDIA_DIR
+
+PACK_DIR = 'packs'  # under MEDIA_DIR
+PACK_SIZE = 2**30  # a pack is sealed once the next file wouldn't fit
+SMALL_FILE = 256 * 1024  # only files up to this size are packed
+BATCH_SIZE = 500
+
+
+def pack_name(pack_id):
+    return f'{PACK_DIR}/pack_{pack_id:06d}.pack'
+
+
+class PackWriter:
+    # appends to the newest unsealed pack, nothing is visible to readers until commit
+    def __init__(self, conn, pack_size=PACK_SIZE):
+        self.conn = conn
+        self.pack_size = pack_size
+        self.pending = []
+        self.fh = None
+        self.open_pack()
+    
+    def open_pack(self):
+        row = self.conn.execute(
+            'SELECT id, path, size FROM media_packs WHERE sealed_at IS NULL ORDER BY id DESC LIMIT 1'
+        ).fetchone()
+        if row is None:
+            with self.conn:
+                cur = self.conn.execute(
+                    'INSERT INTO media_packs (path, size, created_at) VALUES (?, 0, ?)', ('', datetime.utcnow())
+                )
+                row = (cur.lastrowid, pack_name(cur.lastrowid), 0)
+                self.conn.execute('UPDATE media_packs SET path = ? WHERE id = ?', (row[1], row[0]))
+        
+        self.pack_id, self.path, self.size = row
+        dest = MEDIA_DIR / self.path
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.touch()
+        if dest.stat().st_size != self.size:
+            logging.warning(f'{self.path}: dropping {dest.stat().st_size - self.size:,} uncommitted bytes')
+            os.truncate(dest, self.size)
+        
+        self.fh = open(dest, 'ab')
+    
+    def fits(self, length):
+        return self.size == 0 or self.size + length <= self.pack_size
+    
+    def add(self, sid, name, data):
+        start = self.size
+        self.fh.write(data)
+        self.size += len(data)
+        self.pending.append((sid, self.pack_id, start, len(data), name, hashlib.sha256(data).hexdigest(), datetime.utcnow()))
+    
+    def commit(self):
+        # the data is on disk before any row points at it
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO media_packed (id, pack_id, start, length, name, sha256, packed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self.pending
+            )
+            self.conn.execute('UPDATE media_packs SET size = ? WHERE id = ?', (self.size, self.pack_id))
+        
+        committed, self.pending = self.pending, []
+        return [entry[4] for entry in committed]
+    
+    def seal(self, reopen=True):
+        self.fh.close()
+        os.chmod(MEDIA_DIR / self.path, 0o444)
+        with self.conn:
+            self.conn.execute('UPDATE media_packs SET sealed_at = ? WHERE id = ?', (datetime.utcnow(), self.pack_id))
+        
+        logging.info(f'Sealed {self.path} at {self.size / 2**20:,.1f} MiB')
+        if reopen:
+            self.open_pack()
+    
+    def close(self):
+        self.fh.close()
+
+
+def remove_loose(names):
+    for name in names:
+        (MEDIA_DIR / name).unlink(missing_ok=True)
+    
+    return len(names)
+
+
+def iter_unpacked(conn, max_size=SMALL_FILE, batch_size=BATCH_SIZE):
+    # every run starts from the first id, files are stored at any sid (faves of old posts, storer imports),
+    # what's packed or known to be too big is left out by the query so the walk stays cheap
+    last_id = -1
+    while True:
+        rows = conn.execute(
+            'SELECT f.id, f.path FROM files f LEFT JOIN media_packed p ON p.id = f.id '
+            'LEFT JOIN media_pack_skipped s ON s.id = f.id '
+            'WHERE f.id > ? AND p.id IS NULL AND (s.id IS NULL OR s.size <= ?) ORDER BY f.id LIMIT ?',
+            (last_id, max_size, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        
+        last_id = rows[-1][0]
+        yield rows
+
+
+def pack_media(db_path, max_size=SMALL_FILE, pack_size=PACK_SIZE, batch_size=BATCH_SIZE, limit=None):
+    init_media_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    
+    writer = PackWriter(conn, pack_size)
+    scanned = moved = missing = 0
+    bytes_moved = 0
+    start = time.time()
+    
+    try:
+        for rows in iter_unpacked(conn, max_size, batch_size):
+            skipped = []
+            for sid, path in rows:
+                scanned += 1
+                src = MEDIA_DIR / path
+                try:
+                    size = src.stat().st_size
+                    if size > max_size:
+                        skipped.append((sid, size))
+                        continue
+                    
+                    data = src.read_bytes()
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                
+                if not writer.fits(len(data)):
+                    moved += remove_loose(writer.commit())
+                    writer.seal()
+                
+                writer.add(sid, path, data)
+                bytes_moved += len(data)
+            
+            moved += remove_loose(writer.commit())
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO media_pack_skipped (id, size) VALUES (?, ?)', skipped)
+            
+            logging.info(
+                f'Up to {rows[-1][0]}: {scanned:,} scanned, {moved:,} packed ({bytes_moved / 2**20:,.1f} MiB), '
+                f'{missing:,} missing, {scanned / (time.time() - start):,.1f} files/s'
+            )
+            
+            if limit is not None and scanned >= limit:
+                break
+    finally:
+        writer.close()
+        conn.close()
+    
+    logging.info(f'Packed {moved:,} of {scanned:,} files ({bytes_moved / 2**20:,.1f} MiB) in {time.time() - start:,.1f}s')
+    return moved
+
+
+def seal_active(db_path):
+    init_media_db(db_path)
+    with sqlite3.connect(db_path) as conn:
+        writer = PackWriter(conn)
+        if writer.size:
+            writer.seal(reopen=False)
+        else:
+            writer.close()
+
+
+def verify_pack(conn, pack_id, path):
+    bad = []
+    rows = conn.execute('SELECT id, start, length, sha256 FROM media_packed WHERE pack_id = ? ORDER BY start', (pack_id, ))
+    with open(MEDIA_DIR / path, 'rb') as fh:
+        for sid, start, length, sha256 in rows:
+            fh.seek(start)
+            if hashlib.sha256(fh.read(length)).hexdigest() != sha256:
+                bad.append(sid)
+    
+    return bad
+
+
+def verify_packs(db_path):
+    with sqlite3.connect(db_path) as conn:
+        packs = conn.execute('SELECT id, path FROM media_packs ORDER BY id').fetchall()
+        bad = []
+        for pack_id, path in packs:
+            found = verify_pack(conn, pack_id, path)
+            if found:
+                logging.error(f'{path}: {len(found):,} files failed verification: {found[:50]}')
+            
+            bad += found
+        
+        total = conn.execute('SELECT COUNT(*) FROM media_packed').fetchone()[0]
+    
+    if not bad:
+        logging.info(f'All {total:,} packed files in {len(packs):,} packs verified')
+    
+    return not bad
+
+
+def show_status(db_path):
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute(
+            'SELECT k.path, k.size, k.sealed_at, COUNT(p.id) FROM media_packs k '
+            'LEFT JOIN media_packed p ON p.pack_id = k.id GROUP BY k.id ORDER BY k.id'
+        ).fetchall()
+    
+    total = files = 0
+    for path, size, sealed_at, count in rows:
+        total += size
+        files += count
+        state = 'sealed' if sealed_at else 'active'
+        print(f'{path:<28}{size / 2**20:>12,.1f} MiB{count:>12,} files  {state}')
+    
+    print(f'{"total":<28}{total / 2**20:>12,.1f} MiB{files:>12,} files')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack small stored media into append-only pack files.')
+    parser.add_argument('--db', default=DB_MEDIA)
+    subparsers = parser.add_subparsers(dest='command')
+    
+    pack_parser = subparsers.add_parser('pack')
+    pack_parser.add_argument('--max-size', type=int, default=SMALL_FILE, help='Largest file to pack, in bytes')
+    pack_parser.add_argument('--pack-size', type=int, default=PACK_SIZE, help='Seal packs at this size, in bytes')
+    pack_parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    pack_parser.add_argument('--limit', type=int, help='Stop after about this many files')
+    
+    subparsers.add_parser('seal')
+    subparsers.add_parser('verify')
+    subparsers.add_parser('status')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'pack':
+        pack_media(args.db, args.max_size, args.pack_size, args.batch, args.limit)
+    elif args.command == 'seal':
+        seal_active(args.db)
+    elif args.command == 'verify':
+        if not verify_packs(args.db):
+            sys.exit(1)
+    elif args.command == 'status':
+        show_status(args.db)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    config_logger('media_pack')
+    main()
@@ -0,0 +1,122 @@
+# schema migrations
+# versioned, resumable migrations that stream rows instead of loading whole tables
+
+# each database keeps its schema version in PRAGMA user_version, fugsy_lib.run_migrations runs
+# every (version, name, step) above it once, in order. the schema lists live next to the init
+# function that owns the db: MEDIA_MIGRATIONS, PAGES_MIGRATIONS, FAVES_MIGRATIONS, JOBS_MIGRATIONS
+# copy_rows moves a table in key order a chunk at a time, the chunk and its progress
+# commit in one transaction, so an interrupted copy picks up after the last chunk
+
+import argparse
+
+from fugsy_lib import *
+
+BATCH_SIZE = 5000
+REPORT_EVERY = 5.0  # seconds between progress lines
+
+
+def init_progress(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS migration_progress (
+            name TEXT PRIMARY KEY,
+            last_key INTEGER,
+            rows INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME
+        )
+    ''')
+    conn.commit()
+
+
+def load_progress(conn, name):
+    init_progress(conn)
+    row = conn.execute('SELECT last_key, rows, done FROM migration_progress WHERE name = ?', (name, )).fetchone()
+    return row or (None, 0, 0)
+
+
+def save_progress(conn, name, last_key, rows, done=False):
+    conn.execute(
+        'INSERT OR REPLACE INTO migration_progress (name, last_key, rows, done, updated_at) VALUES (?, ?, ?, ?, ?)',
+        (name, last_key, rows, int(done), datetime.utcnow())
+    )
+
+
+def iter_chunks(conn, table, columns, key='id', where=None, start_key=None, batch_size=BATCH_SIZE):
+    # keyset pagination, the key must be the first column and unique
+    select = ', '.join([key] + [c for c in columns if c != key])
+    condition = f' AND ({where})' if where else ''
+    last_key = start_key
+    while True:
+        if last_key is None:
+            rows = conn.execute(
+                f'SELECT {select} FROM {table} WHERE 1{condition} ORDER BY {key} LIMIT ?', (batch_size, )
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT {select} FROM {table} WHERE {key} > ?{condition} ORDER BY {key} LIMIT ?', (last_key, batch_size)
+            ).fetchall()
+        if not rows:
+            break
+        
+        last_key = rows[-1][0]
+        yield rows
+
+
+def copy_rows(src, dest, name, table, columns, insert, transform=None, key='id', where=None, batch_size=BATCH_SIZE):
+    # transform gets each selected row (key first) and returns the insert parameters, or None to drop it
+    last_key, copied, done = load_progress(dest, name)
+    if done:
+        logging.info(f'{name}: already copied {copied:,} rows')
+        return copied
+    
+    if last_key is not None:
+        logging.info(f'{name}: resuming after {key} {last_key}, {copied:,} rows copied so far')
+    
+    start = time.time()
+    last_report = start
+    resumed_from = copied
+    for rows in iter_chunks(src, table, columns, key, where, last_key, batch_size):
+        values = rows if transform is None else [v for v in map(transform, rows) if v is not None]
+        with dest:
+            dest.executemany(insert, values)
+            save_progress(dest, name, rows[-1][0], copied + len(values))
+        
+        copied += len(values)
+        now = time.time()
+        if now - last_report >= REPORT_EVERY:
+            last_report = now
+            logging.info(f'{name}: up to {key} {rows[-1][0]}, {copied:,} rows, {(copied - resumed_from) / (now - start):,.0f} rows/s')
+    
+    with dest:
+        save_progress(dest, name, None, copied, done=True)
+    
+    elapsed = time.time() - start
+    logging.info(f'{name}: copied {copied:,} rows in {elapsed:,.1f}s ({(copied - resumed_from) / max(elapsed, 1e-9):,.0f} rows/s)')
+    return copied
+
+
+def show_status(db_paths):
+    for path in db_paths:
+        with sqlite3.connect(path) as conn:
+            print(f'{path}: version {get_version(conn)}')
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'migration_progress'").fetchone()
+            if not exists:
+                continue
+            
+            for name, last_key, rows, done, updated_at in conn.execute(
+                'SELECT name, last_key, rows, done, updated_at FROM migration_progress ORDER BY updated_at'
+            ):
+                state = 'done' if done else f'at key {last_key}'
+                print(f'  {name:<32}{rows:>12,} rows  {state}  ({updated_at})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show schema versions and migration progress.')
+    parser.add_argument('dbs', nargs='+')
+    args = parser.parse_args()
+    
+    show_status(args.dbs)
+
+
+if __name__ == '__main__':
+    main()
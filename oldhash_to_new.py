@@ -5,6 +5,9 @@ from shutil import copyfile
 from PIL import Image
 import imagehash
 
+from fugsy_lib import config_logger
+from migrate import copy_rows
+
 old_db = 'file_index.db'
 new_db = '../file_index_new.db'
 
@@ -35,23 +38,25 @@ def to_unsigned(val: int) -> int:
         val += 2**64
     return val
 
-def convert_rows():
+def convert_row(row):
+    file_id, path, stored_hash = row
+    path = path.lstrip(BASE_DIR)
+    if isinstance(stored_hash, str):
+        stored_hash = to_signed(int(stored_hash, 16))
+    return file_id, path, stored_hash
+
+def convert_rows(conn):
+    # streams the old table in id order, resumes from migration_progress if interrupted
     with sqlite3.connect(old_db) as oldconn:
-        cur = oldconn.execute("SELECT * FROM files")
-        results = cur.fetchall()
-    
-    with sqlite3.connect(new_db) as conn:
-        for file_id, path, stored_hash in results:
-            path = path.lstrip(BASE_DIR)
-            if isinstance(stored_hash, str):
-                stored_hash = to_signed(int(stored_hash, 16))
-            conn.execute(
-                "INSERT OR REPLACE INTO files (id, path, hash) VALUES (?, ?, ?)",
-                (file_id, path, stored_hash)
-            )
-        conn.commit()
+        copy_rows(
+            oldconn, conn, 'files_from_old_db', 'files', ['id', 'path', 'hash'],
+            "INSERT OR REPLACE INTO files (id, path, hash) VALUES (?, ?, ?)",
+            convert_row
+        )
 
 if __name__ == '__main__':
+    config_logger('oldhash_to_new')
     init_db()
     
-    convert_rows()
\ No newline at end of file
+    with sqlite3.connect(new_db) as conn:
+        convert_rows(conn)
@@ -0,0 +1,106 @@
+# bulk page extractor
+# pull structured fields out of stored pages so nothing has to re-parse html later
+
+# 1. stream pages in id order, skipping ones already extracted since they were stored
+# 2. decompress and parse in a process pool
+# 3. write download url, title, tags, rating, uploader and post date into page_meta
+# partitioned pages are extracted a few partitions at a time, sealed ones only with --all
+
+import argparse
+from multiprocessing import Pool
+
+from fugsy_lib import *
+from fa_common import extract_post_meta
+from faves_get import DB_PAGES
+from pages_store import scan_partitions, page_db_paths
+
+BATCH_SIZE = 2000
+
+
+def parse_row(row):
+    sid, blob, encoding = row
+    try:
+        meta = extract_post_meta(decompress(blob, encoding=encoding or 'detect'))
+    except Exception as e:
+        logging.warning(f'{sid}: could not extract ({e})')
+        return sid, None
+    
+    return sid, meta
+
+
+def iter_pages(conn, start_id=-1, redo=False, batch_size=BATCH_SIZE):
+    last_id = start_id
+    while True:
+        rows = conn.execute(
+            f'''
+            SELECT p.id, p.html, p.encoding FROM pages p
+            LEFT JOIN page_meta m ON m.id = p.id
+            WHERE p.id > ? {"" if redo else "AND (m.id IS NULL OR m.extracted_at < p.created_at)"}
+            ORDER BY p.id LIMIT ?
+            ''',
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        
+        last_id = rows[-1][0]
+        yield rows
+
+
+def extract_pages(db_path, workers=None, redo=False, batch_size=BATCH_SIZE):
+    conn = init_pages_db(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    
+    done = failed = 0
+    start = time.time()
+    
+    with Pool(processes=workers) as pool:
+        for rows in iter_pages(conn, redo=redo, batch_size=batch_size):
+            now = datetime.utcnow()
+            values = []
+            for sid, meta in pool.imap(parse_row, rows, chunksize=32):
+                if meta is None:
+                    failed += 1
+                    continue
+                
+                values.append((
+                    sid, meta['download_url'], meta['title'], ' '.join(meta['tags']),
+                    meta['rating'], meta['uploader'], meta['posted_at'], now
+                ))
+            
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO page_meta (id, download_url, title, tags, rating, uploader, posted_at, extracted_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    values
+                )
+            
+            done += len(values)
+            logging.info(f'Up to {rows[-1][0]}: {done:,} extracted, {failed:,} failed, {done / (time.time() - start):,.0f} pages/s')
+    
+    conn.close()
+    logging.info(f'Extracted {done:,} pages in {time.time() - start:,.1f}s, {failed:,} failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract structured fields from stored pages into page_meta.')
+    parser.add_argument('--db', default=DB_PAGES)
+    parser.add_argument('--workers', type=int, default=None, help='Processes, defaults to the cpu count')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    parser.add_argument('--redo', action='store_true', help='Re-extract pages that already have page_meta')
+    parser.add_argument('--partitions', type=int, default=2, help='Partitions extracted at once')
+    parser.add_argument('--all', action='store_true', help='Include sealed partitions')
+    args = parser.parse_args()
+    
+    # the processes are shared out between the partitions running at once, a single pages.db gets them all
+    running = max(1, min(args.partitions, len(page_db_paths(args.db, args.all))))
+    workers = max(1, (args.workers or os.cpu_count()) // running)
+    scan_partitions(
+        args.db, lambda db_path: extract_pages(db_path, workers, args.redo, args.batch),
+        workers=args.partitions, sealed=args.all
+    )
+
+
+if __name__ == '__main__':
+    config_logger('page_extract')
+    main()
@@ -0,0 +1,311 @@
+# pages.db maintenance
+# background jobs that run next to the crawler without holding the write lock for long
+
+# recompress: rewrite blobs at a higher zstd level in small transactions,
+#  keep the old blob when the new one isn't smaller, then hand freed pages back
+# vacuum: one off switch to auto_vacuum=INCREMENTAL, blocks writers while it runs
+# encoding: backfill pages.encoding for rows stored before it was detected at write time
+# with partitioned pages (see pages_store) every job runs over each active partition in turn,
+#  --all includes sealed ones
+# slim: strip stored pages down to fa_common.slim_page regions, the full page goes to
+#  pages_cold.db first, and the newest revision delta is rebased onto the slim page
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from fugsy_lib import *
+from fa_common import page_hash, slim_page
+from faves_get import DB_PAGES, DB_PAGES_COLD
+from pages_store import page_db_paths
+
+BATCH_SIZE = 200
+TARGET_LEVEL = 19
+VACUUM_PAGES = 2000  # free pages returned per batch
+
+
+def connect(db_path):
+    conn = init_pages_db(db_path)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+def recompress_blob(blob, level):
+    data = decompress(blob, encoding=None)
+    return compress(data, encoding=None, level=level)
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def recompress_pages(db_path, level=TARGET_LEVEL, batch_size=BATCH_SIZE, workers=4, pause=0.1, limit=None):
+    conn = connect(db_path)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logging.warning('auto_vacuum is not INCREMENTAL, freed space stays in the file until `pages_maint.py vacuum`')
+    
+    last_id = -1
+    scanned = rewritten = skipped = 0
+    bytes_before = bytes_after = 0
+    start = time.time()
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while limit is None or scanned < limit:
+            # read outside of any write transaction
+            rows = conn.execute(
+                "SELECT id, html FROM pages WHERE id > ? AND (zlevel IS NULL OR zlevel < ?) ORDER BY id LIMIT ?",
+                (last_id, level, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            
+            last_id = rows[-1][0]
+            recompressed = list(pool.map(lambda row: recompress_blob(row[1], level), rows))
+            
+            updates = []
+            marks = []
+            for (sid, old), new in zip(rows, recompressed):
+                scanned += 1
+                if len(new) < len(old):
+                    updates.append((new, level, sid, old))
+                    bytes_before += len(old)
+                    bytes_after += len(new)
+                else:
+                    marks.append((level, sid, old))
+                    skipped += 1
+            
+            # short write transaction, the html = ? check drops rows the crawler replaced meanwhile
+            with conn:
+                conn.executemany("UPDATE pages SET html = ?, zlevel = ? WHERE id = ? AND html = ?", updates)
+                conn.executemany("UPDATE pages SET zlevel = ? WHERE id = ? AND html = ?", marks)
+            
+            rewritten += len(updates)
+            incremental_vacuum(conn)
+            
+            elapsed = time.time() - start
+            logging.info(
+                f'Up to {last_id}: {scanned:,} scanned, {rewritten:,} rewritten, {skipped:,} not smaller, '
+                f'{(bytes_before - bytes_after) / 2**20:,.1f} MiB saved, {scanned / elapsed:,.0f} rows/s, '
+                f'{bytes_before / 2**20 / elapsed:,.2f} MiB/s'
+            )
+            
+            time.sleep(pause)
+    
+    conn.close()
+    
+    elapsed = time.time() - start
+    saved = bytes_before - bytes_after
+    logging.info(
+        f'Done: {scanned:,} rows in {elapsed:,.1f}s, {rewritten:,} rewritten, {skipped:,} kept, '
+        f'{saved / 2**20:,.1f} MiB saved ({saved / max(bytes_before, 1):.1%} of rewritten rows)'
+    )
+    return saved
+
+
+def detect_blob_encoding(row):
+    sid, blob = row
+    try:
+        return sid, detect_encoding(decompress(blob, encoding=None))
+    except Exception as e:
+        logging.warning(f'{sid}: could not detect encoding ({e})')
+        return sid, None
+
+
+def backfill_encoding(db_path, batch_size=BATCH_SIZE, workers=None, pause=0.1):
+    conn = connect(db_path)
+    last_id = -1
+    done = undetected = 0
+    start = time.time()
+    
+    # charset detection is pure python, so this one uses processes
+    with Pool(processes=workers) as pool:
+        while True:
+            rows = conn.execute(
+                "SELECT id, html FROM pages WHERE id > ? AND encoding IS NULL ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            
+            last_id = rows[-1][0]
+            results = pool.map(detect_blob_encoding, rows, chunksize=16)
+            blobs = dict(rows)
+            
+            updates = [(encoding, sid, blobs[sid]) for sid, encoding in results if encoding]
+            undetected += len(rows) - len(updates)
+            with conn:
+                conn.executemany("UPDATE pages SET encoding = ? WHERE id = ? AND html = ?", updates)
+            
+            done += len(updates)
+            logging.info(f'Up to {last_id}: {done:,} backfilled, {undetected:,} undetected, {done / (time.time() - start):,.0f} rows/s')
+            time.sleep(pause)
+    
+    conn.close()
+    logging.info(f'Backfilled encoding for {done:,} rows in {time.time() - start:,.1f}s')
+
+
+def slim_row(row):
+    sid, blob, rev, delta = row
+    try:
+        content = decompress(blob, encoding=None)
+        slimmed = slim_page(content)
+    except Exception as e:
+        logging.warning(f'{sid}: could not slim ({e})')
+        return sid, None
+    
+    if slimmed is content:
+        return sid, None
+    
+    # the newest revision is a delta against the full page, make it one against the slim page
+    new_delta = None
+    if rev is not None:
+        new_delta = delta_compress(delta_decompress(delta, content), slimmed)
+    
+    return sid, (compress(slimmed, encoding=None), page_hash(slimmed), detect_encoding(slimmed), new_delta)
+
+
+def slim_pages(db_path, cold_path, batch_size=BATCH_SIZE, workers=None, pause=0.1, limit=None):
+    conn = connect(db_path)
+    cold = connect(cold_path)
+    
+    last_id = -1
+    scanned = slimmed = kept = 0
+    bytes_before = bytes_after = 0
+    start = time.time()
+    
+    with Pool(processes=workers) as pool:
+        while limit is None or scanned < limit:
+            rows = conn.execute(
+                """
+                SELECT p.id, p.html, p.created_at, p.zlevel, p.content_hash, p.last_seen, p.encoding, r.rev, r.delta
+                FROM pages p
+                LEFT JOIN page_revisions r ON r.id = p.id AND r.rev = (SELECT MAX(rev) FROM page_revisions WHERE id = p.id)
+                WHERE p.id > ? AND p.slim IS NULL ORDER BY p.id LIMIT ?
+                """,
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            
+            last_id = rows[-1][0]
+            results = dict(pool.map(slim_row, [(row[0], row[1], row[7], row[8]) for row in rows], chunksize=8))
+            
+            # originals go to cold storage and are committed before anything is replaced
+            with cold:
+                cold.executemany(
+                    "INSERT OR REPLACE INTO pages (id, html, created_at, zlevel, content_hash, last_seen, encoding, slim) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                    [row[:7] for row in rows if results[row[0]]]
+                )
+            
+            with conn:
+                for sid, blob, *_, rev, _ in rows:
+                    scanned += 1
+                    result = results[sid]
+                    if not result:
+                        conn.execute("UPDATE pages SET slim = 0 WHERE id = ? AND html = ?", (sid, blob))
+                        kept += 1
+                        continue
+                    
+                    new_blob, content_hash, encoding, new_delta = result
+                    cursor = conn.execute(
+                        "UPDATE pages SET html = ?, content_hash = ?, encoding = ?, zlevel = NULL, slim = 1 WHERE id = ? AND html = ?",
+                        (new_blob, content_hash, encoding, sid, blob)
+                    )
+                    if not cursor.rowcount:
+                        continue  # refetched meanwhile, picked up next run
+                    
+                    if new_delta is not None:
+                        conn.execute("UPDATE page_revisions SET delta = ? WHERE id = ? AND rev = ?", (new_delta, sid, rev))
+                    
+                    slimmed += 1
+                    bytes_before += len(blob)
+                    bytes_after += len(new_blob)
+            
+            incremental_vacuum(conn)
+            
+            elapsed = time.time() - start
+            logging.info(
+                f'Up to {last_id}: {scanned:,} scanned, {slimmed:,} slimmed, {kept:,} kept whole, '
+                f'{(bytes_before - bytes_after) / 2**20:,.1f} MiB saved, {scanned / elapsed:,.0f} rows/s'
+            )
+            time.sleep(pause)
+    
+    conn.close()
+    cold.close()
+    
+    saved = bytes_before - bytes_after
+    logging.info(
+        f'Done: {slimmed:,} pages slimmed in {time.time() - start:,.1f}s, '
+        f'{saved / 2**20:,.1f} MiB saved ({saved / max(bytes_before, 1):.1%} of slimmed rows)'
+    )
+    return saved
+
+
+def enable_incremental_vacuum(db_path):
+    conn = connect(db_path)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        logging.info('auto_vacuum is already INCREMENTAL')
+        return
+    
+    logging.warning('Running a full VACUUM to switch to auto_vacuum=INCREMENTAL, writers are blocked until it ends')
+    start = time.time()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.close()
+    logging.info(f'VACUUM done in {time.time() - start:,.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance jobs for pages.db')
+    parser.add_argument('--db', default=DB_PAGES)
+    parser.add_argument('--all', action='store_true', help='Include sealed partitions')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    recompress_parser = subparsers.add_parser('recompress')
+    recompress_parser.add_argument('--level', type=int, default=TARGET_LEVEL)
+    recompress_parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    recompress_parser.add_argument('--workers', type=int, default=4)
+    recompress_parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+    recompress_parser.add_argument('--limit', type=int, help='Stop after this many rows')
+    
+    subparsers.add_parser('vacuum')
+    
+    encoding_parser = subparsers.add_parser('encoding')
+    encoding_parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    encoding_parser.add_argument('--workers', type=int, default=None)
+    encoding_parser.add_argument('--pause', type=float, default=0.1)
+    
+    slim_parser = subparsers.add_parser('slim')
+    slim_parser.add_argument('--cold', default=DB_PAGES_COLD, help='Where the full pages are kept')
+    slim_parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+    slim_parser.add_argument('--workers', type=int, default=None)
+    slim_parser.add_argument('--pause', type=float, default=0.1)
+    slim_parser.add_argument('--limit', type=int, help='Stop after this many rows')
+    
+    args = parser.parse_args()
+    
+    if not args.command:
+        parser.print_help()
+        return
+    
+    for db_path in page_db_paths(args.db, sealed=args.all):
+        logging.info(f'{args.command}: {db_path}')
+        if args.command == 'recompress':
+            recompress_pages(db_path, args.level, args.batch, args.workers, args.pause, args.limit)
+        elif args.command == 'vacuum':
+            enable_incremental_vacuum(db_path)
+        elif args.command == 'encoding':
+            backfill_encoding(db_path, args.batch, args.workers, args.pause)
+        elif args.command == 'slim':
+            slim_pages(db_path, args.cold, args.batch, args.workers, args.pause, args.limit)
+
+
+if __name__ == '__main__':
+    config_logger('pages_maint')
+    main()
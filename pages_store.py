@@ -0,0 +1,309 @@
+# pages storage
+# pages.db either as one file, or as a directory of files each holding a range of sids
+
+# DB_PAGES pointing at a directory turns partitioning on, every partition is a normal pages
+# db (pages, page_revisions, page_meta) named pages_<lo>_<hi>.db for sids lo <= sid < hi
+# partitions.db next to them records which partitions are sealed, a sealed partition is
+# vacuumed and checked once and then left out of maintenance and backups by default
+# a write to a sealed partition unseals it again, so sealing is only ever an optimisation
+
+# split: copy an existing single pages.db into partitions, resumable via migrate.copy_rows
+# seal: seal partitions below the newest one that haven't been written to for a while
+# status: list partitions with their size and state
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from fugsy_lib import *
+from migrate import copy_rows
+
+PARTITION_SIZE = 5_000_000  # sids per partition, only used for partitions that don't exist yet
+SEAL_AFTER_DAYS = 30
+SEAL_LOCK_TIMEOUT = 300  # seconds a writer waits while a partition is being checked for sealing
+CATALOG = 'partitions.db'
+
+# root -> sorted [(lo, hi, path)], refreshed when a sid isn't covered
+partition_cache = {}
+
+
+def is_partitioned(db_pages):
+    return Path(db_pages).is_dir()
+
+
+def init_catalog(root):
+    with sqlite3.connect(Path(root) / CATALOG) as conn:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS partitions (
+                name TEXT PRIMARY KEY,
+                lo INTEGER,
+                hi INTEGER,
+                sealed_at DATETIME,
+                rows INTEGER,
+                bytes INTEGER
+            )
+        ''')
+        conn.commit()
+
+
+def init_pages_store(db_pages):
+    if is_partitioned(db_pages):
+        init_catalog(db_pages)
+    else:
+        init_pages_db(db_pages).close()
+
+
+def list_partitions(root, refresh=False):
+    if refresh or root not in partition_cache:
+        found = []
+        for path in Path(root).glob('pages_*_*.db'):
+            lo, hi = map(int, path.stem.split('_')[1:3])
+            found.append((lo, hi, path))
+        
+        partition_cache[root] = sorted(found)
+    
+    return partition_cache[root]
+
+
+def partition_name(lo, hi):
+    return f'pages_{lo:09d}_{hi:09d}.db'
+
+
+def page_db_path(db_pages, sid, create=False):
+    if not is_partitioned(db_pages):
+        return db_pages
+    
+    for refresh in (False, True):
+        for lo, hi, path in list_partitions(db_pages, refresh):
+            if lo <= sid < hi:
+                return path
+    
+    if not create:
+        return None
+    
+    lo = sid // PARTITION_SIZE * PARTITION_SIZE
+    path = Path(db_pages) / partition_name(lo, lo + PARTITION_SIZE)
+    init_pages_db(path).close()
+    list_partitions(db_pages, refresh=True)
+    logging.info(f'Created pages partition {path.name}')
+    return path
+
+
+def page_db_paths(db_pages, sealed=True):
+    # every db holding pages, sealed=False leaves out partitions that are sealed
+    if not is_partitioned(db_pages):
+        return [db_pages]
+    
+    paths = [path for _, _, path in list_partitions(db_pages, refresh=True)]
+    if not sealed:
+        paths = [path for path in paths if not is_sealed(db_pages, path)]
+    
+    return paths
+
+
+def connect_page_db(db_pages, sid, write=False):
+    # None when reading a sid whose partition doesn't exist yet
+    path = page_db_path(db_pages, sid, create=write)
+    if path is None:
+        return None
+    
+    if not write or not is_partitioned(db_pages):
+        return sqlite3.connect(path)
+    
+    # the seal check runs inside the write transaction, seal_partition holds the same lock from its
+    # checks to its catalog insert, so a write either lands before the checks or sees the seal
+    conn = sqlite3.connect(path, timeout=SEAL_LOCK_TIMEOUT)
+    conn.execute('BEGIN IMMEDIATE')
+    if is_sealed(db_pages, path):
+        unseal_partition(db_pages, path)
+    
+    return conn
+
+
+def existing_ids(db_pages, ids, table='pages'):
+    by_path = {}
+    for sid in ids:
+        path = page_db_path(db_pages, sid)
+        if path is not None:
+            by_path.setdefault(path, []).append(sid)
+    
+    found = []
+    for path, sids in by_path.items():
+        with sqlite3.connect(path) as conn:
+            for i in range(0, len(sids), 500):
+                chunk = sids[i:i + 500]
+                cursor = conn.execute(f"SELECT id FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                found += [row[0] for row in cursor]
+    
+    return found
+
+
+def is_sealed(root, path):
+    with sqlite3.connect(Path(root) / CATALOG) as conn:
+        row = conn.execute('SELECT sealed_at FROM partitions WHERE name = ?', (Path(path).name, )).fetchone()
+    
+    return bool(row and row[0])
+
+
+def unseal_partition(root, path):
+    logging.warning(f'Write to sealed pages partition {Path(path).name}, unsealing it')
+    with sqlite3.connect(Path(root) / CATALOG) as conn:
+        conn.execute('UPDATE partitions SET sealed_at = NULL WHERE name = ?', (Path(path).name, ))
+        conn.commit()
+
+
+def last_write(path):
+    with sqlite3.connect(path) as conn:
+        row = conn.execute('SELECT MAX(MAX(COALESCE(created_at, 0)), MAX(COALESCE(last_seen, 0))), COUNT(*) FROM pages').fetchone()
+    
+    return row
+
+
+def seal_partition(root, lo, hi, path):
+    # the last full pass over the file, maintenance skips it from here on
+    start = time.time()
+    conn = sqlite3.connect(path, isolation_level=None, timeout=SEAL_LOCK_TIMEOUT)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        # writers wait from here until the catalog says sealed, so nothing lands unchecked in between
+        conn.execute("BEGIN IMMEDIATE")
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        rows = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        if result != 'ok':
+            logging.error(f'{path.name}: quick_check failed, not sealing: {result}')
+            return False
+    
+        with sqlite3.connect(Path(root) / CATALOG) as catalog:
+            catalog.execute(
+                'INSERT OR REPLACE INTO partitions (name, lo, hi, sealed_at, rows, bytes) VALUES (?, ?, ?, ?, ?, ?)',
+                (path.name, lo, hi, datetime.utcnow(), rows, path.stat().st_size)
+            )
+            catalog.commit()
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+    
+    logging.info(f'Sealed {path.name}: {rows:,} pages, {path.stat().st_size / 2**20:,.1f} MiB in {time.time() - start:,.1f}s')
+    return True
+
+
+def seal_idle_partitions(root, days=SEAL_AFTER_DAYS):
+    # the newest partition is where new posts land, it's never sealed
+    partitions = list_partitions(root, refresh=True)
+    cutoff = str(datetime.utcnow() - timedelta(days=days))
+    sealed = 0
+    for lo, hi, path in partitions[:-1]:
+        if is_sealed(root, path):
+            continue
+        
+        written, rows = last_write(path)
+        if rows and str(written) > cutoff:
+            logging.info(f'{path.name}: written {written}, not sealing yet')
+            continue
+        
+        sealed += seal_partition(root, lo, hi, path)
+    
+    return sealed
+
+
+def split_ranges(src, size):
+    # only ranges that have pages in them
+    ranges = []
+    for (bucket, ) in src.execute('SELECT DISTINCT id / ? FROM pages ORDER BY 1', (size, )):
+        ranges.append((bucket * size, (bucket + 1) * size))
+    
+    return ranges
+
+
+def split_pages(src_path, root, size=PARTITION_SIZE, batch_size=2000):
+    # copies, never deletes, point DB_PAGES at root once it's done
+    Path(root).mkdir(parents=True, exist_ok=True)
+    init_catalog(root)
+    init_pages_db(src_path).close()  # older files may be missing newer columns
+    src = sqlite3.connect(f'file:{src_path}?mode=ro', uri=True)
+    
+    pages_columns = ['id', 'html', 'created_at', 'zlevel', 'content_hash', 'last_seen', 'encoding', 'slim']
+    meta_columns = ['id', 'download_url', 'title', 'tags', 'rating', 'uploader', 'posted_at', 'extracted_at']
+    revision_columns = ['id', 'rev', 'created_at', 'content_hash', 'delta']
+    
+    start = time.time()
+    for lo, hi in split_ranges(src, size):
+        path = Path(root) / partition_name(lo, hi)
+        dest = init_pages_db(path)
+        where = f'id >= {lo} AND id < {hi}'
+        
+        copy_rows(
+            src, dest, f'split_pages_{lo}', 'pages', pages_columns,
+            f"INSERT OR REPLACE INTO pages ({', '.join(pages_columns)}) VALUES ({', '.join('?' * len(pages_columns))})",
+            where=where, batch_size=batch_size
+        )
+        copy_rows(
+            src, dest, f'split_page_meta_{lo}', 'page_meta', meta_columns,
+            f"INSERT OR REPLACE INTO page_meta ({', '.join(meta_columns)}) VALUES ({', '.join('?' * len(meta_columns))})",
+            where=where, batch_size=batch_size
+        )
+        # revisions have a composite key, so they page by rowid and drop it on insert
+        copy_rows(
+            src, dest, f'split_page_revisions_{lo}', 'page_revisions', revision_columns,
+            f"INSERT OR REPLACE INTO page_revisions ({', '.join(revision_columns)}) VALUES ({', '.join('?' * len(revision_columns))})",
+            transform=lambda row: row[1:], key='rowid', where=where, batch_size=batch_size
+        )
+        dest.close()
+    
+    src.close()
+    list_partitions(root, refresh=True)
+    logging.info(f'Split {src_path} into {len(list_partitions(root)):,} partitions in {time.time() - start:,.1f}s')
+
+
+def scan_partitions(db_pages, fn, workers=4, sealed=True):
+    # run fn(path) over every partition at once, each partition is its own file and lock
+    paths = page_db_paths(db_pages, sealed)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, paths))
+
+
+def show_status(root):
+    total = 0
+    for lo, hi, path in list_partitions(root, refresh=True):
+        size = path.stat().st_size
+        total += size
+        state = 'sealed' if is_sealed(root, path) else 'active'
+        print(f'{path.name:<36}{size / 2**20:>12,.1f} MiB  {state}')
+    
+    print(f'{"total":<36}{total / 2**20:>12,.1f} MiB')
+
+
+def main():
+    from faves_get import DB_PAGES  # faves_get imports this module
+    
+    parser = argparse.ArgumentParser(description='Partitioned pages storage.')
+    parser.add_argument('--root', default=DB_PAGES, help='Partition directory')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    split_parser = subparsers.add_parser('split')
+    split_parser.add_argument('src', help='Single file pages.db to split')
+    split_parser.add_argument('--size', type=int, default=PARTITION_SIZE, help='Sids per partition')
+    split_parser.add_argument('--batch', type=int, default=2000)
+    
+    seal_parser = subparsers.add_parser('seal')
+    seal_parser.add_argument('--days', type=int, default=SEAL_AFTER_DAYS, help='Idle days before sealing')
+    
+    subparsers.add_parser('status')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'split':
+        split_pages(args.src, args.root, args.size, args.batch)
+    elif args.command == 'seal':
+        seal_idle_partitions(args.root, args.days)
+    elif args.command == 'status':
+        show_status(args.root)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    config_logger('pages_store')
+    main()
@@ -0,0 +1,110 @@
+# pipeline latency report
+# how long posts take from showing up in the faves to being notified, and where they wait
+
+# faves_get records when each post first reached each stage in post_timeline:
+#  discovered (new fave or imported page) -> page stored -> media downloaded -> hashed -> notified
+# latency: percentiles for each step and end to end, over posts that finished the step in the window
+# backlog: posts that reached a stage but not the next one yet, with how long they've been waiting,
+#  media deferred by thumbnail prescreening isn't counted as waiting
+
+import argparse
+
+from fugsy_lib import *
+from faves_get import DB_FAVES, DB_MEDIA
+
+STAGES = ['discovered', 'page', 'media', 'hashed', 'notified']
+PERCENTILES = [50, 90, 99]
+WINDOW_DAYS = 7
+
+
+def format_duration(seconds):
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if abs(seconds) >= size:
+            return f'{seconds / size:,.1f}{unit}'
+    
+    return f'{seconds:,.1f}s'
+
+
+def seconds_between(conn, first, last, since):
+    cursor = conn.execute(
+        f'SELECT (julianday({last}_at) - julianday({first}_at)) * 86400 FROM post_timeline '
+        f'WHERE {first}_at IS NOT NULL AND {last}_at IS NOT NULL AND {last}_at >= ?',
+        (since, )
+    )
+    return np.array([row[0] for row in cursor], dtype=np.float64)
+
+
+def latency_rows(conn, since):
+    # each step, then end to end
+    steps = list(zip(STAGES, STAGES[1:])) + [(STAGES[0], STAGES[-1])]
+    rows = []
+    for first, last in steps:
+        seconds = seconds_between(conn, first, last, since)
+        rows.append((f'{first} -> {last}', seconds))
+    
+    return rows
+
+
+def backlog_rows(conn, now):
+    # waiting for a stage: the previous one is done and this one isn't, a notified post isn't waiting for
+    # anything (media that can't be hashed still gets notified), the wait counts from the previous stage
+    rows = []
+    for previous, stage in zip(STAGES, STAGES[1:]):
+        deferred = 'AND sid NOT IN (SELECT id FROM media.media_deferred)' if stage == 'media' else ''
+        cursor = conn.execute(
+            f'SELECT (julianday(?) - julianday({previous}_at)) * 86400 FROM post_timeline '
+            f'WHERE {previous}_at IS NOT NULL AND {stage}_at IS NULL AND notified_at IS NULL {deferred}',
+            (now, )
+        )
+        rows.append((stage, np.array([row[0] for row in cursor], dtype=np.float64)))
+    
+    return rows
+
+
+def show_latency(conn, since, target=None):
+    print(f'Latency since {since:%Y-%m-%d %H:%M}')
+    header = ''.join(f'{f"p{p}":>10}' for p in PERCENTILES)
+    print(f'{"step":<28}{"posts":>10}{header}{"max":>10}')
+    for name, seconds in latency_rows(conn, since):
+        if not len(seconds):
+            print(f'{name:<28}{0:>10,}')
+            continue
+        
+        values = ''.join(f'{format_duration(v):>10}' for v in np.percentile(seconds, PERCENTILES))
+        print(f'{name:<28}{len(seconds):>10,}{values}{format_duration(seconds.max()):>10}')
+    
+    if target is not None:
+        seconds = latency_rows(conn, since)[-1][1]
+        within = (seconds <= target).mean() if len(seconds) else 0.0
+        print(f'{within:.1%} of {len(seconds):,} posts notified within {format_duration(target)} of discovery')
+
+
+def show_backlog(conn, now):
+    print(f'Backlog at {now:%Y-%m-%d %H:%M}')
+    print(f'{"waiting for":<28}{"posts":>10}{"p50 age":>10}{"oldest":>10}')
+    for stage, ages in backlog_rows(conn, now):
+        if not len(ages):
+            print(f'{stage:<28}{0:>10,}')
+            continue
+        
+        print(f'{stage:<28}{len(ages):>10,}{format_duration(np.median(ages)):>10}{format_duration(ages.max()):>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pipeline latency percentiles and backlog ages from post_timeline.')
+    parser.add_argument('--db', default=DB_FAVES)
+    parser.add_argument('--media-db', default=DB_MEDIA, help='For media deferred by prescreening')
+    parser.add_argument('--days', type=float, default=WINDOW_DAYS, help='Only count steps finished in the last days')
+    parser.add_argument('--target', type=float, help='Freshness target in minutes, reports the share of posts within it')
+    args = parser.parse_args()
+    
+    now = datetime.utcnow()
+    with sqlite3.connect(f'file:{args.db}?mode=ro', uri=True) as conn:
+        conn.execute('ATTACH DATABASE ? AS media', (f'file:{args.media_db}?mode=ro', ))
+        show_latency(conn, now - timedelta(days=args.days), args.target * 60 if args.target is not None else None)
+        print()
+        show_backlog(conn, now)
+
+
+if __name__ == '__main__':
+    main()
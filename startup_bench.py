@@ -0,0 +1,87 @@
+# startup time benchmark
+# import each entry point in a fresh interpreter and check it against a budget
+
+# 1. time `import <module>` in a subprocess a few times, keep the median
+# 2. compare against the budget, anything over is reported and fails the run
+# 3. --profile <module> prints the slowest imports from python -X importtime
+
+import argparse
+import statistics
+import subprocess
+
+from fugsy_lib import *
+
+# seconds for a bare import, short cron driven runs should stay well under these
+BUDGETS = {
+    'faves_get': 0.10,
+    'storer': 0.10,
+    'legacy_postpage_improter': 0.10,
+    'media_man': 0.50,
+    'media_load': 0.50,
+    'exporter': 1.00,
+}
+
+TIMER = 'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+
+
+def time_import(module, runs=5):
+    times = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', TIMER.format(module=module)],
+            capture_output=True, text=True, check=True
+        )
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    
+    return statistics.median(times)
+
+
+def profile_import(module, top=20):
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True
+    )
+    
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        
+        self_us, cumulative_us, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    
+    rows.sort(reverse=True)
+    print(f'{"cumulative ms":>14}{"self ms":>10}  module')
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f'{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check entry point import time against a budget.')
+    parser.add_argument('modules', nargs='*', default=list(BUDGETS))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--profile', help='Show the slowest imports for one module')
+    args = parser.parse_args()
+    
+    if args.profile:
+        profile_import(args.profile)
+        return
+    
+    over = 0
+    print(f'{"module":<28}{"median ms":>10}{"budget ms":>10}')
+    for module in args.modules:
+        took = time_import(module, args.runs)
+        budget = BUDGETS.get(module)
+        flag = ''
+        if budget is not None and took > budget:
+            flag = '  OVER BUDGET'
+            over += 1
+        
+        print(f'{module:<28}{took * 1000:>10.1f}{(budget or 0) * 1000:>10.0f}{flag}')
+    
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,23 @@
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from shutil import copyfile, move
-from PIL import Image
-import imagehash
 
 import logging
 from datetime import datetime, timedelta
 from sys import stdout
 
+from fugsy_lib import lazy_import, start_profiler, run_migrations, MEDIA_MIGRATIONS
+
+Image = lazy_import('PIL.Image')
+imagehash = lazy_import('imagehash')
+
 # --- Config ---
 BASE_DIR = Path("/agic/media_idx")  # Root directory where files will be stored
 DB_PATH = "file_index.db"       # SQLite3 DB file
+SOURCE_DIR = "/stra/media/fa/im"
+SCAN_WORKERS = 16
 
 
 def config_logger():
@@ -29,10 +35,13 @@ def config_logger():
     logging.getLogger().addHandler(logging.StreamHandler(stdout))
 
     logging.info(f'Logging Started')
+    
+    start_profiler('storer', now)
 
 # Create the DB if not exists
 def init_db():
     with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY,
@@ -41,6 +50,8 @@ def init_db():
             )
         """)
         conn.commit()
+        # the same file index faves_get uses, so it shares its version numbers (the manifest is one of them)
+        run_migrations(conn, MEDIA_MIGRATIONS)
 
 # Get hierarchical path for a numeric filename
 def get_storage_path(file_id: int) -> Path:
@@ -57,12 +68,90 @@ def calculate_average_hash(image_path: str) -> str:
         logging.warning(f"Could not hash image: {e}")
         return None
 
+# Walk one folder, returning (path, size, mtime, inode) per file
+def scan_folder(folder: str):
+    entries = []
+    if not os.path.isdir(folder):
+        return entries
+    
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            
+            st = entry.stat(follow_symlinks=False)
+            entries.append((entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+    
+    return entries
+
+# Walk the 100 source folders in parallel, scandir releases the GIL on stat
+def scan_source(root: str = SOURCE_DIR, workers: int = SCAN_WORKERS):
+    folders = [f'{root}/{i:02d}' for i in range(100)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entries in pool.map(scan_folder, folders):
+            yield from entries
+
+# Manifest rows for paths under the source dir, stored files are cached under their destination
+def load_manifest(root: str = SOURCE_DIR):
+    with sqlite3.connect(DB_PATH) as conn:
+        cur = conn.execute(
+            "SELECT path, size, mtime, inode FROM manifest WHERE path >= ? AND path < ?",
+            (root + '/', root + '0')  # '0' sorts right after '/'
+        )
+        return {path: (size, mtime, inode) for path, size, mtime, inode in cur}
+
+# Drop source rows for files that aren't there any more
+def prune_manifest(manifest, entries):
+    gone = manifest.keys() - {entry[0] for entry in entries}
+    if not gone:
+        return 0
+    
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.executemany("DELETE FROM manifest WHERE path = ?", [(path,) for path in gone])
+        conn.commit()
+    
+    for path in gone:
+        del manifest[path]
+    return len(gone)
+
+# Only keep entries whose path is new or whose size/mtime/inode moved
+def changed_entries(entries, manifest):
+    for path, size, mtime, inode in entries:
+        if manifest.get(path) != (size, mtime, inode):
+            yield path, size, mtime, inode
+
+def file_key(path: str):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+def cached_hash(path: str, key):
+    with sqlite3.connect(DB_PATH) as conn:
+        cur = conn.execute(
+            "SELECT hash FROM manifest WHERE path = ? AND size = ? AND mtime = ? AND inode = ? AND hashed = 1",
+            (path, *key)
+        )
+        row = cur.fetchone()
+    
+    if row:
+        return True, row[0]
+    
+    return False, None
+
+def record_manifest(conn, path: str, key, file_hash):
+    conn.execute(
+        "INSERT OR REPLACE INTO manifest (path, size, mtime, inode, hash, hashed) VALUES (?, ?, ?, ?, ?, 1)",
+        (path, *key, file_hash)
+    )
+
 # Store file and update DB
-def store_file(src_path: str, file_id: int):
+def store_file(src_path: str, file_id: int, key=None):
     ext = Path(src_path).suffix  # keep the extension (.jpg, .png, .txt, etc.)
     dest_path = get_storage_path(file_id).with_suffix(ext)
     dest_path.parent.mkdir(parents=True, exist_ok=True)  # Create dirs if needed
     
+    if key is None:
+        key = file_key(src_path)
+    
     # First check if file_id already exists in DB
     #with sqlite3.connect(DB_PATH) as conn:
     #    cur = conn.execute("SELECT 1 FROM files WHERE id = ?", (file_id,))
@@ -70,23 +159,36 @@ def store_file(src_path: str, file_id: int):
     #        logging.info(f"File ID {file_id} already exists in DB, skipping.")
     #        return
     
-    # Compute hash if image
-    file_hash = None
-    try:
-        file_hash = calculate_average_hash(src_path)
-    except Exception:
-        pass  # Non-image files just store path
+    # Compute hash if image, unless this exact file was stored and hashed before (a move keeps the key)
+    hit, file_hash = cached_hash(str(dest_path), key)
+    if not hit:
+        try:
+            file_hash = calculate_average_hash(src_path)
+        except Exception:
+            pass  # Non-image files just store path
     
     # Copy file
     move(src_path, dest_path)
     
     # Store index
     with sqlite3.connect(DB_PATH) as conn:
+        archived = conn.execute("SELECT archive_path FROM media_archive WHERE id = ?", (file_id,)).fetchone()
         conn.execute(
             "INSERT OR REPLACE INTO files (id, path, hash) VALUES (?, ?, ?)",
             (file_id, str(dest_path), file_hash)
         )
+        # the new loose copy replaces a packed or archived one, as in faves_get.store_post_media
+        conn.execute("DELETE FROM media_packed WHERE id = ?", (file_id,))
+        conn.execute("DELETE FROM media_archive WHERE id = ?", (file_id,))
+        conn.execute("DELETE FROM media_pack_skipped WHERE id = ?", (file_id,))
+        # the source is moved away, a later file at the same path is new whatever its key,
+        # so the hash is only cached against the stored copy
+        conn.execute("DELETE FROM manifest WHERE path = ?", (src_path,))
+        record_manifest(conn, str(dest_path), file_key(dest_path), file_hash)
         conn.commit()
+    
+    if archived and archived[0] and BASE_DIR / archived[0] != dest_path:
+        (BASE_DIR / archived[0]).unlink(missing_ok=True)
     logging.debug(f"Stored file {file_id} at {dest_path} (hash: {file_hash})")
 
 # Retrieve file path by ID
@@ -161,12 +263,27 @@ if __name__ == "__main__":
 
 def rehash_missing_files():
     with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT id, path FROM files WHERE hash IS NULL")
+        # packed files have no loose copy to hash, and they're the small non-image ones anyway
+        cur = conn.execute(
+            "SELECT id, path FROM files WHERE hash IS NULL AND id NOT IN (SELECT id FROM media_packed)"
+        )
         rows = cur.fetchall()
 
+    skipped = 0
     for file_id, path in rows:
         try:
-            file_hash = calculate_average_hash(path)
+            key = file_key(path)
+            hit, file_hash = cached_hash(path, key)
+            if hit and not file_hash:
+                skipped += 1  # already failed on this exact file
+                continue
+            
+            if not hit:
+                file_hash = calculate_average_hash(path)
+                with sqlite3.connect(DB_PATH) as conn:
+                    record_manifest(conn, path, key, file_hash)
+                    conn.commit()
+            
             if file_hash:
                 with sqlite3.connect(DB_PATH) as conn:
                     conn.execute(
@@ -182,6 +299,9 @@ def rehash_missing_files():
         
         except Exception as e:
             logging.error(f"Error hashing file ID {file_id} at {path}: {e}")
+    
+    if skipped:
+        logging.info(f"Skipped {skipped:,} unchanged unhashable files")
 
 
 if __name__ == "__main__":
@@ -190,14 +310,23 @@ if __name__ == "__main__":
     
     rehash_missing_files()
     
-    for i in range(100):
-        fol = f'{i:02d}'
-        logging.info(f'Checking dir {fol}')
+    manifest = load_manifest()
+    logging.info(f'Scanning {SOURCE_DIR} ({len(manifest):,} source paths in manifest)')
+    
+    entries = list(scan_source())
+    pruned = prune_manifest(manifest, entries)
+    if pruned:
+        logging.info(f'Pruned {pruned:,} manifest rows for files no longer in {SOURCE_DIR}')
+    
+    stored = 0
+    for path, size, mtime, inode in changed_entries(entries, manifest):
+        fn = os.path.basename(path)
+        sid = fn.split('.')[0]
+        if not sid.isnumeric():
+            logging.warning(f'Invalid name: {fn}')
+            continue
         
-        for fn in os.listdir(f'/stra/media/fa/im/{fol}/'):
-            sid = fn.split('.')[0]
-            if not sid.isnumeric():
-                logging.warning(f'Invalid name: {fn}')
-                continue
-                
-            store_file(f'/stra/media/fa/im/{fol}/{fn}', int(sid))
\ No newline at end of file
+        store_file(path, int(sid), (size, mtime, inode))
+        stored += 1
+    
+    logging.info(f'Stored {stored:,} new or changed files')
\ No newline at end of file
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pyarrow.dataset as ds
+import pytest
+
+import exporter
+
+
+@pytest.fixture
+def faves_db(tmp_path, monkeypatch):
+    db = str(tmp_path / 'favourites.db')
+    with sqlite3.connect(db) as conn:
+        conn.execute('CREATE TABLE faves (user TEXT NOT NULL, sid INTEGER NOT NULL, UNIQUE(user, sid))')
+        conn.executemany('INSERT INTO faves (user, sid) VALUES (?, ?)', [('me', sid) for sid in range(1, 6)])
+    
+    monkeypatch.setattr(exporter, 'EXPORT_DIR', tmp_path / 'export')
+    monkeypatch.setitem(exporter.TABLES['faves'], 'db', db)
+    return db
+
+
+def latest_snapshot(table):
+    snapshot = sorted((exporter.EXPORT_DIR / table).iterdir())[-1]
+    rows = ds.dataset(snapshot, format='parquet', partitioning='hive').to_table(columns=['user', 'sid', 'deleted'])
+    return sorted(rows.to_pylist(), key=lambda row: (row['deleted'], row['sid']))
+
+
+def test_delete_then_insert_reusing_the_rowid_keeps_the_tombstone(faves_db):
+    state = {}
+    exporter.export_table('faves', state)
+    
+    with sqlite3.connect(faves_db) as conn:
+        last_rowid = conn.execute('SELECT MAX(rowid) FROM faves').fetchone()[0]
+        conn.execute('DELETE FROM faves WHERE sid = 5')
+        conn.execute("INSERT INTO faves (user, sid) VALUES ('other', 1)")
+        assert conn.execute("SELECT rowid FROM faves WHERE user = 'other'").fetchone()[0] == last_rowid
+    
+    exporter.export_table('faves', state)
+    assert latest_snapshot('faves') == [
+        {'user': 'other', 'sid': 1, 'deleted': False},
+        {'user': 'me', 'sid': 5, 'deleted': True},
+    ]
+
+
+def test_unknown_table_is_rejected(faves_db):
+    with pytest.raises(ValueError, match='Unknown table'):
+        exporter.export_table('nope', {})
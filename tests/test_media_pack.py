@@ -0,0 +1,35 @@
+import sqlite3
+
+import media_pack
+from fugsy_lib import init_media_db, media_location, read_media
+
+
+def store(db, media_dir, sid, data):
+    path = f'{sid:09d}.txt'
+    (media_dir / path).write_bytes(data)
+    with sqlite3.connect(db) as conn:
+        conn.execute('INSERT INTO files (id, path, hash) VALUES (?, ?, 0)', (sid, path))
+
+
+def test_pack_picks_up_lower_sid_stored_after_a_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_pack, 'MEDIA_DIR', tmp_path)
+    db = str(tmp_path / 'file_index.db')
+    init_media_db(db)
+    
+    store(db, tmp_path, 500, b'later sid')
+    store(db, tmp_path, 600, b'x' * 100)
+    assert media_pack.pack_media(db, max_size=50) == 1
+    
+    store(db, tmp_path, 100, b'lower sid, stored after the first run')
+    assert media_pack.pack_media(db, max_size=50) == 1
+    
+    with sqlite3.connect(db) as conn:
+        packed = [row[0] for row in conn.execute('SELECT id FROM media_packed ORDER BY id')]
+        skipped = [row[0] for row in conn.execute('SELECT id FROM media_pack_skipped')]
+        path, _, start, length = media_location(conn, 100)
+    
+    assert packed == [100, 500]
+    assert skipped == [600]
+    assert not (tmp_path / '000000100.txt').exists()
+    assert read_media(tmp_path, path, start, length) == b'lower sid, stored after the first run'
+    assert media_pack.verify_packs(db)